@@ -0,0 +1,537 @@
+import pandas as pd
+import numpy as np
+from SweepPlan import SweepPlan, products
+from History import History
+from RandomStreams import RandomStreams
+from Scenario import Scenario
+import instrument
+
+
+def block_shape(num_people, num_universes, betas, memory_budget, dtype=np.float64):
+    """Returns how many people and universes to simulate together in one Cohort
+
+    Estimates the memory needed to hold one person's state, random draws,
+    history and the temporaries of the per sweep matrix products in one
+    universe, along with their row of the people they are read from, and
+    the memory for each universe's coefficients. The whole cohort is
+    simulated together in as many universes as fit in the budget, or if
+    not even one universe of the whole cohort fits, one universe at a time
+    in chunks of as many people as fit, so memory use is bounded by the
+    budget however large the cohort is.
+
+    Parameters
+    ----------
+    num_people : int
+        The number of individuals in the cohort
+    num_universes : int
+        The number of universes still to simulate
+    betas : DataFrame
+        The regression coefficients, used for the number of independent
+        variables and equations
+    memory_budget : int
+        The number of bytes available for a block of people and universes
+    dtype : dtype, optional
+        The float type the state and history are held in
+
+    Returns
+    -------
+    int
+        The number of people per chunk, always at least 1
+    int
+        The number of universes per block, always at least 1
+    """
+
+    num_vars, num_outcomes = betas.shape
+    itemsize = np.dtype(dtype).itemsize
+    # x, history (at most one column per variable and outcome) and the
+    # matrix product results in dtype, the random draws of a sweep and the
+    # person's row of the people in float64 and their social care status
+    bytes_per_person = itemsize * (2 * num_vars + 3 * num_outcomes) + 8 * (num_outcomes + num_vars) + 1
+    bytes_per_universe = itemsize * num_vars * num_outcomes
+
+    if memory_budget >= num_people * bytes_per_person + bytes_per_universe:
+        universes = memory_budget // (num_people * bytes_per_person + bytes_per_universe)
+        return max(1, num_people), int(max(1, min(num_universes, universes)))
+    return int(max(1, (memory_budget - bytes_per_universe) // bytes_per_person)), 1
+
+
+class Cohort:
+    """
+    A class used to represent and simulate the whole MCS cohort from birth to age 17
+
+    This is the vectorized counterpart of Person. Rather than simulating
+    each individual separately it holds everyone as a single
+    num_people x num_vars matrix and simulates each sweep for the whole
+    cohort at once using one matrix product per sweep for the continuous
+    equations and another for the binary equations. Given the same betas
+    and probs it produces the same outcomes as running
+    Person.simulate_all_sweeps for every individual.
+
+    Several parameter universes can be simulated together by passing lists
+    of betas and probs. These are stacked into a num_universes x num_vars x
+    num_outcomes coefficient tensor and every universe is advanced through
+    each sweep with a single batched matrix product. The products are
+    evaluated by products, which sums over the variables in the same order
+    for every person, so the outcomes of a person do not depend on which
+    other people or universes are simulated alongside them.
+
+    The random draws can be passed either as probs or as a RandomStreams
+    that draws only what each sweep needs as it is simulated. Each universe
+    can be simulated under its own Scenario of how social care works, the
+    same universe number under several scenarios sharing the same draws,
+    and with antithetic draws, 1 - u in place of each draw u. The state and
+    history can be held as float32 to halve their memory, the products are
+    then evaluated in float32 too.
+
+    ...
+
+    Attributes
+    ----------
+    mcsid: ndarray
+        contains the unique MCSID of each individual to allow linking back to the raw data
+    x : ndarray
+        num_universes x num_people x num_vars array of person specific
+        characteristics, the last axis is positionally aligned with the rows of betas
+    betas : ndarray
+        num_universes x num_vars x num_outcomes tensor of the regression
+        coefficients for the lifecourse trajectory equations
+    probs : ndarray or RandomStreams
+        num_universes x num_people x num_draws array of random draws to compare
+        the results of the binary equations with in order to decide whether
+        a binary outcome occurred, laid out as plan.probs_names, or the
+        streams to draw them from sweep by sweep
+    universes : ndarray
+        The universe number of each universe, used to pick the random streams
+    person_ids : ndarray
+        The position of each person in the full cohort, used to pick the
+        random streams
+    dtype : dtype
+        The float type x, betas and history are held in
+    scenarios : list of Scenario
+        The scenario each universe is simulated under
+    antithetic : ndarray
+        Whether each universe uses antithetic draws
+    plan : SweepPlan
+        The compiled positional layout of the sweeps
+    social_care : ndarray
+        num_universes x num_people boolean array recording whether each
+        person is currently in social care
+    history : History
+        Keeps track of the lifecourse trajectory of every person in every universe
+    contexts : dict
+        Maps a sweep number to the context factors recalculated from the
+        whole cohort just before that sweep is simulated
+    interventions : dict
+        Maps a sweep number to the policy interventions applied just before
+        that sweep is simulated
+    checkpoints : dict
+        Maps a sweep number to a copy of x, betas and social_care as they
+        were at the end of that sweep, 1 being the starting conditions
+
+    Methods
+    -------
+    simulate_sweep(sweep_num)
+        Simulates an MCS sweep for the whole cohort updating x and adding to history
+    simulate_all_sweeps(checkpoint=False)
+        Simulates all 7 sweeps of MCS taking the cohort from birth to age 17,
+        or only the sweeps affected by interventions changed since the last run
+    register_context(sweep_num, factor)
+        Adds a context factor to recalculate just before a sweep
+    register_intervention(sweep_num, intervention)
+        Adds a policy intervention to apply just before a sweep
+    clear_interventions(sweep_num=None)
+        Removes the policy interventions of a sweep or of every sweep
+    """
+
+
+    def __init__(self, people, betas, probs, plan=None, history=None, universes=None, person_ids=None,
+                 dtype=np.float64, scenarios=None, antithetic=None):
+        """
+        Parameters
+        ----------
+        people : DataFrame
+            Contains all person specific characteristics for every individual
+            including placeholders for characteristics that will be simulated
+            for MCS sweeps 2-7, one row per person
+        betas : DataFrame or list of DataFrame
+            Contains the regression coefficients for the lifecourse trajectory
+            equations with rows representing independent variables coefficients
+            and columns representing dependent (outcome) variables, pass a
+            list to simulate one universe per element
+        probs : DataFrame or list of DataFrame or RandomStreams
+            Contains random draws, one row per person, to compare the results
+            of the binary equations with in order to decide whether a binary
+            outcome occurred, one element per universe if betas is a list,
+            or the streams to draw them from as each sweep is simulated
+        plan : SweepPlan, optional
+            The compiled positional layout of the sweeps, built from betas
+            if not given
+        history : History, optional
+            The store to save the history to, a new store of dtype is
+            created if not given
+        universes : array_like, optional
+            The universe number of each element of betas, defaults to
+            0 to num_universes - 1
+        person_ids : array_like, optional
+            The position of each person in the full cohort, defaults to
+            0 to num_people - 1
+        dtype : dtype, optional
+            The float type to hold the state and history in, e.g.
+            np.float32 to halve their memory, default float64
+        scenarios : list of Scenario, optional
+            The scenario to simulate each element of betas under, defaults
+            to the baseline Scenario for all
+        antithetic : array_like, optional
+            Whether to use antithetic draws for each element of betas,
+            defaults to False for all
+        """
+
+        if isinstance(betas, pd.DataFrame):
+            betas = [betas]
+            if not isinstance(probs, RandomStreams):
+                probs = [probs]
+        if not isinstance(probs, RandomStreams):
+            if len(betas) != len(probs):
+                raise ValueError(f"Got {len(betas)} sets of betas but {len(probs)} sets of probs")
+
+        plan = plan if plan is not None else SweepPlan(betas[0], support=betas)
+        if not isinstance(probs, RandomStreams):
+            probs = np.stack([p[plan.probs_names].values for p in probs])
+        self._start(plan,
+                    people['mcsid_age0'].values,
+                    people[plan.x_names].values,
+                    np.stack([b.values for b in betas]),
+                    probs,
+                    history, universes, person_ids, dtype=dtype, scenarios=scenarios, antithetic=antithetic)
+
+
+    @classmethod
+    def from_arrays(cls, plan, mcsid, x, betas, probs, history=None, universes=None, person_ids=None,
+                    social_care=None, dtype=np.float64, scenarios=None, antithetic=None):
+        """Creates a Cohort directly from arrays laid out as the plan
+
+        Avoids any label lookups so it is cheap enough to call on every
+        chunk of people, e.g. inside a worker process.
+
+        Parameters
+        ----------
+        plan : SweepPlan
+            The compiled positional layout of the sweeps
+        mcsid : ndarray
+            The MCSID of each person
+        x : ndarray
+            num_people x num_vars person characteristics laid out as
+            plan.x_names, or num_universes x num_people x num_vars state of
+            every universe which the cohort then updates in place
+        betas : ndarray
+            num_universes x num_vars x num_outcomes regression coefficients
+        probs : ndarray or RandomStreams
+            num_universes x num_people x num_draws random draws laid out as
+            plan.probs_names, or the streams to draw them from
+        history : History, optional
+            The store to save the history to, a new store of dtype is
+            created if not given
+        universes : array_like, optional
+            The universe number of each element of betas
+        person_ids : array_like, optional
+            The position of each person in the full cohort
+        social_care : ndarray, optional
+            num_universes x num_people social care status to continue from,
+            updated in place, nobody is in care if not given
+        dtype : dtype, optional
+            The float type to hold the state and history in, a 3-D x of
+            another type is copied rather than updated in place
+        scenarios : list of Scenario, optional
+            The scenario to simulate each universe under
+        antithetic : array_like, optional
+            Whether to use antithetic draws for each universe
+
+        Returns
+        -------
+        Cohort
+            The cohort ready to simulate
+        """
+
+        cohort = cls.__new__(cls)
+        cohort._start(plan, mcsid, x, betas, probs, history, universes, person_ids, social_care, dtype,
+                      scenarios, antithetic)
+        return cohort
+
+
+    def _start(self, plan, mcsid, x, betas, probs, history, universes=None, person_ids=None, social_care=None,
+               dtype=np.float64, scenarios=None, antithetic=None):
+        """Sets up the starting conditions of every universe"""
+
+        self.plan = plan
+        self.mcsid = mcsid
+        self.dtype = np.dtype(dtype)
+        self.betas = np.asarray(betas, dtype=self.dtype)
+        self.probs = probs if isinstance(probs, RandomStreams) else np.asarray(probs, dtype=float)
+        x = np.asarray(x, dtype=self.dtype)
+        self.x = x if x.ndim == 3 else np.repeat(x[np.newaxis], len(self.betas), axis=0)
+        self.universes = np.arange(len(self.betas)) if universes is None else np.asarray(universes)
+        self.person_ids = np.arange(len(mcsid)) if person_ids is None else np.asarray(person_ids)
+        self.social_care = social_care if social_care is not None else np.zeros(self.x.shape[:2], dtype=bool)
+        self.scenarios = [Scenario()] * len(self.betas) if scenarios is None else list(scenarios)
+        self.antithetic = np.zeros(len(self.betas), dtype=bool) if antithetic is None else np.asarray(antithetic, dtype=bool)
+
+        # the social care settings of every universe's scenario side by side
+        self._social_care_p = np.stack([scenario.social_care_p for scenario in self.scenarios])
+        self._zcog_decrement = np.array([scenario.zcog_decrement for scenario in self.scenarios], dtype=float)
+        self._con_emo_increment = np.array([scenario.con_emo_increment for scenario in self.scenarios], dtype=float)
+
+        # no sweeps have been simulated yet
+        self.contexts = {}
+        self.interventions = {}
+        self.checkpoints = {}
+        self._simulated = 1
+        self._changed = 2
+
+        # save starting conditions to history
+        self.history = history if history is not None else History(self.plan, self.mcsid, len(self.betas), self.dtype)
+
+        # a cohort continuing from a given state has already saved them
+        if social_care is not None:
+            return
+
+        # manually add a variable to capture social care status intialised to 0
+        self.history.values[:, :, self.history.social_care_slots[0]] = 0
+
+        # add all the age0 variables as starting coditions
+        self.history.values[:, :, self.history.initial_slots] = self.x[:, :, self.plan.initial_positions]
+
+
+    def _draws(self, sweep):
+        """Returns the random draws of a sweep laid out as sweep.draws"""
+
+        instrument.count('cohort.draws', self.x.shape[0] * self.x.shape[1] * len(sweep.draws))
+        if isinstance(self.probs, RandomStreams):
+            # the scenarios of a universe share its draws so each universe is only drawn once
+            drawn = {}
+            with instrument.timer('streams.draws', sweep=sweep.sweep_num):
+                for universe in self.universes:
+                    if universe not in drawn:
+                        drawn[universe] = self.probs.sweep_draws(universe, sweep.sweep_num, self.person_ids)
+                draws = np.stack([drawn[universe] for universe in self.universes])
+        else:
+            draws = self.probs[:, :, sweep.draws]
+        if self.antithetic.any():
+            draws = np.where(self.antithetic[:, np.newaxis, np.newaxis], 1 - draws, draws)
+        return draws
+
+
+    def simulate_sweep(self, sweep_num):
+        """Simulates an MCS sweep for the whole cohort
+
+        Mirrors Person.simulate_sweep but operates on every individual in
+        every universe at once. The continuous and binary equations are each
+        evaluated with a single batched product of the predictors of x that
+        the sweep uses with the relevant betas, the bounds on con and emo, the income carry forward
+        and the social care draw are all applied as array operations.
+
+        Parameters
+        ----------
+        sweep_num : int
+            The sweep that you want to simulate
+            sweep 1   2   3   4   5   6   7
+            age   0   3   5   7   11  14  17
+        """
+
+        if sweep_num not in self.plan.sweeps:
+            # handle invalid sweep_num values
+            raise ValueError(f"Invalid sweep_num value: {sweep_num}\nNote: sweep_num must be between 2 and 7")
+        sweep = self.plan.sweeps[sweep_num]
+
+        instrument.count('cohort.people_sweeps', self.x.shape[0] * self.x.shape[1])
+        with instrument.timer('cohort.sweep', sweep=sweep_num):
+            # outcomes are written back into x except for sweep 7
+            # whose outcomes are not currently recorded in x
+            outputs = self.x if sweep.in_x else np.zeros(self.x.shape[:2] + (len(sweep.outputs_names),))
+
+            #####################################################
+            # calculate continuous outcome equations
+            #####################################################
+
+            # only the predictors used by the sweep's equations take part
+            betas = self.betas[:, sweep.predictors]
+
+            with instrument.timer('cohort.products', sweep=sweep_num):
+                x = np.take(self.x, sweep.predictors, axis=2)
+                continuous_outcomes = products(x, betas[:, :, sweep.continuous_cols])
+            outputs[:, :, sweep.continuous_targets] = continuous_outcomes[:, :, sweep.continuous_keep]
+
+            # bound con and emo between 0 and 10
+            for i in [sweep.con, sweep.emo]:
+                outputs[:, :, i] = np.clip(outputs[:, :, i], 0, 10)
+
+            # set income equal to income in previous period
+            outputs[:, :, sweep.log_eqv_inc] = self.x[:, :, sweep.log_eqv_inc_prev]
+
+            #####################################################
+            # calculate binary outcome equations
+            #####################################################
+
+            # log odds ratios converted to threshold probabilities using the sigmoid function
+            with instrument.timer('cohort.products', sweep=sweep_num):
+                x = np.take(self.x, sweep.predictors, axis=2)
+                xb = products(x, betas[:, :, sweep.binary_cols])
+            threshold_p = 1 / (1 + np.exp(-xb))
+
+            # compare with the random probabilities to decide whether each outcome occurred
+            draws = self._draws(sweep)
+            binary_outcomes = (draws[:, :, :-1] < threshold_p).astype(float)
+            outputs[:, :, sweep.binary_targets] = binary_outcomes[:, :, sweep.binary_keep]
+
+            ######################################################################
+            # calculate social care outcome and adjust other outcomes accordingly
+            ######################################################################
+
+            # probability of entering social care is determined by IMD
+            social_care_p = self.plan.social_care_p(self.x, self._social_care_p)
+            enters = ~self.social_care & (draws[:, :, -1] < social_care_p)
+
+            # Person records 1 for those already in care, 0 for those who stay
+            # out of care and nothing for the sweep in which someone enters care
+            social_care_history = np.where(self.social_care, 1.0, 0.0)
+            social_care_history[enters] = np.nan
+            self.social_care |= enters
+
+            # adjust zcog, emo and con to make them deteriorate in response to entering social care
+            # by as much as the scenario of each universe sets
+            # TODO: find some plausible values to adjust by
+            if sweep.zcog is not None:
+                outputs[enters, sweep.zcog] -= np.broadcast_to(self._zcog_decrement[:, np.newaxis], enters.shape)[enters]
+            increment = np.broadcast_to(self._con_emo_increment[:, np.newaxis], enters.shape)[enters]
+            for i in [sweep.con, sweep.emo]:
+                outputs[enters, i] = np.minimum(outputs[enters, i] + increment, 10)
+
+            #####################################################
+            # save sweep level outcomes to history
+            #####################################################
+
+            self.history.values[:, :, self.history.social_care_slots[sweep.age]] = social_care_history
+            self.history.values[:, :, self.history.sweep_slots[sweep_num]] = outputs[:, :, sweep.history_positions]
+
+
+    def register_context(self, sweep_num, factor):
+        """Adds a context factor to recalculate just before a sweep
+
+        The factor is calculated from the whole cohort of each universe, as
+        it stands after the previous sweep, and written into x before any
+        interventions for the sweep are applied.
+
+        Parameters
+        ----------
+        sweep_num : int
+            The sweep the factor is recalculated before, between 2 and 7
+        factor : ContextFactor
+            The group level aggregate to calculate
+        """
+
+        if sweep_num not in self.plan.sweeps:
+            # handle invalid sweep_num values
+            raise ValueError(f"Invalid sweep_num value: {sweep_num}\nNote: sweep_num must be between 2 and 7")
+
+        self.contexts.setdefault(sweep_num, []).append(factor)
+        self._changed = min(self._changed, sweep_num)
+
+
+    def register_intervention(self, sweep_num, intervention):
+        """Adds a policy intervention to apply just before a sweep
+
+        The intervention is called with the cohort once the previous sweep
+        has been simulated and can change x and/or betas in place, e.g.
+        raising zcog for everyone in the most deprived IMD decile before
+        sweep 5. The change is picked up by the sweep and every sweep after
+        it the next time simulate_all_sweeps is run.
+
+        Parameters
+        ----------
+        sweep_num : int
+            The sweep the intervention is applied before, between 2 and 7
+        intervention : callable
+            Called as intervention(cohort)
+        """
+
+        if sweep_num not in self.plan.sweeps:
+            # handle invalid sweep_num values
+            raise ValueError(f"Invalid sweep_num value: {sweep_num}\nNote: sweep_num must be between 2 and 7")
+
+        self.interventions.setdefault(sweep_num, []).append(intervention)
+        self._changed = min(self._changed, sweep_num)
+
+
+    def clear_interventions(self, sweep_num=None):
+        """Removes the policy interventions of a sweep or of every sweep
+
+        Parameters
+        ----------
+        sweep_num : int, optional
+            The sweep to remove the interventions of, all sweeps if not given
+        """
+
+        removed = list(self.interventions) if sweep_num is None else [sweep_num]
+        for i in removed:
+            if self.interventions.pop(i, None):
+                self._changed = min(self._changed, i)
+
+
+    def _check_predictors(self, sweep_num):
+        """Raises an error if betas now use predictors the plan pruned"""
+
+        for later in range(sweep_num, 8):
+            if not self.plan.sweeps[later].covers(self.betas):
+                raise ValueError(f"Intervention gave nonzero betas to predictors pruned from sweep {later}, "
+                                 f"build the plan with the changed betas as support")
+
+
+    def simulate_all_sweeps(self, checkpoint=False):
+        """Simulates all MCS sweeps for the whole cohort
+
+        This runs the simulation for sweeps 2 through to 7 sequentially
+        advancing every individual in every universe in lockstep,
+        recalculating the registered context factors and then applying the
+        registered interventions before each sweep.
+
+        With checkpoint set the state at the start of each sweep is kept,
+        so after registering or clearing interventions a later run restores
+        the state before the first affected sweep and only simulates from
+        there on, e.g. an intervention at age 11 does not repeat the sweeps
+        for ages 3, 5 and 7. The random draws of a sweep are the same each
+        time it is simulated so runs differ only by the interventions.
+
+        Parameters
+        ----------
+        checkpoint : bool
+            Whether to keep a copy of the state at the start of each sweep
+        """
+
+        start = min(self._changed, self._simulated + 1)
+        if start <= self._simulated:
+            # earlier results are out of date so wind back to before the first affected sweep
+            if start - 1 not in self.checkpoints:
+                raise ValueError(f"No checkpoint to re-simulate from sweep {start}, "
+                                 f"run simulate_all_sweeps(checkpoint=True) first")
+            x, betas, social_care = self.checkpoints[start - 1]
+            self.x[:] = x
+            self.betas = betas.copy()
+            self.social_care = social_care.copy()
+
+        # checkpoints from later sweeps no longer match the state
+        for i in [i for i in self.checkpoints if i >= start]:
+            del self.checkpoints[i]
+
+        for sweep_num in range(start, 8):
+            if checkpoint:
+                self.checkpoints[sweep_num - 1] = (self.x.copy(), self.betas.copy(), self.social_care.copy())
+            for factor in self.contexts.get(sweep_num, []):
+                with instrument.timer('cohort.context', sweep=sweep_num):
+                    factor.apply(self.x)
+            for intervention in self.interventions.get(sweep_num, []):
+                intervention(self)
+            if sweep_num in self.interventions:
+                self._check_predictors(sweep_num)
+            self.simulate_sweep(sweep_num)
+            self._simulated = sweep_num
+
+        self._changed = 8
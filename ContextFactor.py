@@ -0,0 +1,161 @@
+import numpy as np
+
+# the group level statistics a context factor can take
+STATS = ['mean', 'sum', 'count']
+
+
+def group_reduce(values, groups, stat='mean', exclude_self=False):
+    """Reduces values within groups separately for every universe
+
+    Each group is labelled by a unique combination of the grouping
+    variables and the reduction is done in one pass with bincount over
+    the universe and group codes, so it costs little more than sorting
+    the grouping variables however many universes and groups there are.
+
+    Parameters
+    ----------
+    values : ndarray
+        num_universes x num_people values to reduce
+    groups : ndarray
+        num_universes x num_people x num_by grouping variables
+    stat : str
+        One of 'mean', 'sum' or 'count'
+    exclude_self : bool
+        Whether to leave each person out of their own group, e.g. for the
+        mean of a person's peers
+
+    Returns
+    -------
+    ndarray
+        num_universes x num_people value of the group each person is in,
+        NaN for the mean of a group with no one else in it
+    """
+
+    if stat not in STATS:
+        raise ValueError(f"Invalid stat value: {stat}\nNote: stat must be one of {STATS}")
+
+    num_universes, num_people = values.shape
+    groups = groups.reshape(num_universes * num_people, -1)
+
+    # code each grouping variable separately and combine the codes as the
+    # digits of one number, which is much faster than finding unique rows
+    codes = np.zeros(num_universes * num_people, dtype=np.int64)
+    for column in groups.T:
+        levels, column_codes = np.unique(column, return_inverse=True)
+        codes = codes * len(levels) + column_codes
+    codes = np.unique(codes, return_inverse=True)[1].reshape(num_universes, num_people)
+
+    # give every universe its own run of group codes
+    num_groups = codes.max() + 1
+    codes = codes + num_groups * np.arange(num_universes)[:, np.newaxis]
+
+    counts = np.bincount(codes.ravel(), minlength=num_universes * num_groups)[codes].astype(float)
+    sums = np.bincount(codes.ravel(), weights=values.ravel(), minlength=num_universes * num_groups)[codes]
+    if exclude_self:
+        counts -= 1
+        sums -= values
+
+    if stat == 'count':
+        return counts
+    if stat == 'sum':
+        return sums
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+class ContextFactor:
+    """
+    A class used to represent a cohort specific context factor such as a peer effect
+
+    A context factor is a group level aggregate of a person characteristic,
+    e.g. the mean zcog of everyone in the same IMD decile, that is
+    recalculated for the whole cohort between sweeps and fed back to each
+    person through a variable of x so the following sweeps can use it. As it
+    depends on everyone in the cohort it must be calculated with the cohort
+    advanced in lockstep. When each person is left out of their own group
+    the mean of a person with no one else in their group is undefined, so
+    they take the mean of everyone else in their universe instead rather
+    than a NaN that would make every later outcome of theirs missing.
+
+    ...
+
+    Attributes
+    ----------
+    target : str
+        The variable of x the factor is written to
+    source : str
+        The variable of x that is aggregated
+    by : list of str
+        The variables of x defining the groups, e.g. ['imd1_age0'] or the
+        dummy variables of country or ethnicity
+    stat : str
+        One of 'mean', 'sum' or 'count'
+    exclude_self : bool
+        Whether to leave each person out of their own group, a mean for a
+        person alone in their group falls back to the mean of everyone else
+        in their universe
+
+    Methods
+    -------
+    apply(x)
+        Calculates the factor and writes it to the target variable of x
+    """
+
+
+    def __init__(self, plan, target, source, by, stat='mean', exclude_self=False):
+        """
+        Parameters
+        ----------
+        plan : SweepPlan
+            The compiled positional layout of the sweeps, used to find
+            the variables in x
+        target : str
+            The variable of x the factor is written to
+        source : str
+            The variable of x that is aggregated
+        by : str or list of str
+            The variables of x defining the groups
+        stat : str, optional
+            One of 'mean', 'sum' or 'count'
+        exclude_self : bool, optional
+            Whether to leave each person out of their own group
+        """
+
+        if stat not in STATS:
+            raise ValueError(f"Invalid stat value: {stat}\nNote: stat must be one of {STATS}")
+
+        self.target = target
+        self.source = source
+        self.by = [by] if isinstance(by, str) else list(by)
+        self.stat = stat
+        self.exclude_self = exclude_self
+
+        self._target = plan.x_names.get_loc(target)
+        self._source = plan.x_names.get_loc(source)
+        self._by = plan.x_names.get_indexer(self.by)
+        if (self._by < 0).any():
+            raise KeyError(f"Not in x: {[b for b, i in zip(self.by, self._by) if i < 0]}")
+
+
+    def apply(self, x):
+        """Calculates the factor and writes it to the target variable of x
+
+        Parameters
+        ----------
+        x : ndarray
+            num_universes x num_people x num_vars person characteristics
+            laid out as plan.x_names, updated in place
+        """
+
+        source = x[:, :, self._source]
+        values = group_reduce(source, x[:, :, self._by], self.stat, self.exclude_self)
+
+        # people with no peers in their group take the mean of everyone else in their universe
+        lonely = np.isnan(values)
+        if lonely.any():
+            everyone = group_reduce(source, np.zeros(source.shape + (1,)), self.stat, self.exclude_self)
+            values = np.where(lonely, everyone, values)
+            if np.isnan(values).any():
+                raise ValueError(f"Cannot calculate {self.target}, a universe has no one to take the "
+                                 f"{self.stat} of {self.source} over")
+        x[:, :, self._target] = values
@@ -0,0 +1,142 @@
+import pandas as pd
+import numpy as np
+
+
+class History:
+    """
+    A class used to store the simulated lifecourse trajectories of a cohort
+
+    The history is held in a single array preallocated up front with one
+    slot for every universe, person and {variable}_age{age} column. The
+    columns are fixed by the sweep plan so simulation code writes straight
+    into its slots rather than building rows. Slots that are never written,
+    such as social care in the sweep someone enters care, stay missing.
+
+    ...
+
+    Attributes
+    ----------
+    mcsid : ndarray
+        contains the unique MCSID of each individual to allow linking back to the raw data
+    columns : Index
+        the {variable}_age{age} names of the last axis of values, sorted by
+        variable name and then age
+    variables : Index
+        the variable name of each column
+    ages : ndarray
+        the age of each column
+    binary : ndarray
+        boolean mask of the columns holding binary outcomes, which are the
+        binary equations and social care status
+    values : ndarray
+        num_universes x num_people x num_columns array of the history
+    initial_slots : ndarray
+        the columns of the starting conditions in plan.initial_positions order
+    social_care_slots : dict
+        maps each age to the column recording social care status at that age
+    sweep_slots : dict
+        maps each sweep number to the columns of its history_positions
+
+    Methods
+    -------
+    wide(universe)
+        Returns the history of a universe as a wide DataFrame without copying
+    long(universe)
+        Returns the history of a universe in one row per variable format
+    """
+
+
+    def __init__(self, plan, mcsid, num_universes=1, dtype=np.float64, values=None):
+        """
+        Parameters
+        ----------
+        plan : SweepPlan
+            The compiled positional layout of the sweeps which fixes the columns
+        mcsid : array_like
+            The MCSID of each person
+        num_universes : int, optional
+            The number of parameter universes to hold, default 1
+        dtype : dtype, optional
+            The float type to store values as, default float64
+        values : ndarray, optional
+            An existing num_universes x num_people x num_columns buffer to
+            write into, for example one held in shared memory
+        """
+
+        self.mcsid = np.asarray(mcsid)
+
+        # the columns recorded at age 0 and at each sweep
+        keys = [('social_care', 0)] + [(name, 0) for name in plan.initial_names]
+        for sweep in plan.sweeps.values():
+            keys += [('social_care', sweep.age)] + [(name, sweep.age) for name in sweep.history_names]
+        keys = sorted(set(keys))
+        slot = {key: i for i, key in enumerate(keys)}
+
+        self.variables = pd.Index([var for var, _ in keys])
+        self.ages = np.array([age for _, age in keys])
+        self.columns = pd.Index(['{}_age{}'.format(var, age) for var, age in keys])
+        binary_names = [name for sweep in plan.sweeps.values() for name in sweep.binary_names]
+        self.binary = self.columns.isin(binary_names) | (self.variables == 'social_care')
+
+        self.initial_slots = np.array([slot[(name, 0)] for name in plan.initial_names], dtype=int)
+        self.social_care_slots = {age: slot[('social_care', age)] for age in np.unique(self.ages)}
+        self.sweep_slots = {sweep_num: np.array([slot[(name, sweep.age)] for name in sweep.history_names], dtype=int)
+                            for sweep_num, sweep in plan.sweeps.items()}
+
+        shape = (num_universes, len(self.mcsid), len(self.columns))
+        if values is None:
+            values = np.full(shape, np.nan, dtype=dtype)
+        elif values.shape != shape:
+            raise ValueError(f"History values must have shape {shape} but got {values.shape}")
+        self.values = values
+
+
+    def wide(self, universe=0):
+        """Returns the history of one universe in wide form
+
+        The DataFrame is a view onto the store so building it is free and
+        it reflects any later writes to the store.
+
+        Parameters
+        ----------
+        universe : int
+            The position of the universe within the store, default 0
+
+        Returns
+        -------
+        DataFrame
+            The history indexed by mcsid with one {variable}_age{age} column
+            per simulated variable
+        """
+
+        return pd.DataFrame(self.values[universe], index=pd.Index(self.mcsid, name='mcsid'),
+                            columns=self.columns, copy=False)
+
+
+    def long(self, universe=0):
+        """Returns the history of one universe in long form
+
+        Produces the one row per variable format with mcsid, mcs_sweep,
+        age, variable and value columns, leaving out missing slots.
+
+        Parameters
+        ----------
+        universe : int
+            The position of the universe within the store, default 0
+
+        Returns
+        -------
+        DataFrame
+            The history in long form ordered by person and then column
+        """
+
+        # sweep numbers 1 to 7 in age order
+        sweep_nums = np.searchsorted(np.unique(self.ages), self.ages) + 1
+
+        values = self.values[universe]
+        person, column = np.nonzero(~np.isnan(values))
+        return pd.DataFrame({'mcsid': self.mcsid[person],
+                             'mcs_sweep': sweep_nums[column],
+                             'age': self.ages[column],
+                             'variable': self.variables[column],
+                             'value': values[person, column]})
@@ -0,0 +1,421 @@
+import json
+import os
+import pickle
+import shutil
+from Summary import Summary, ScenarioSummary
+
+
+def _fsync_directory(path):
+    """Makes the files created in or renamed into a directory durable
+
+    Windows cannot open a directory to sync it, its renames are durable
+    once the file itself is.
+    """
+
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class OutputSink:
+    """
+    A class used to write simulated histories out as each universe finishes
+
+    Subclasses decide the file format. Every sink records the run metadata
+    alongside the histories so outputs can be traced back to their inputs.
+    A universe too large to hold at once can be written in several parts,
+    one per chunk of people, and is finished once every part is written.
+
+    ...
+
+    Attributes
+    ----------
+    path : str
+        Where the output is written
+    metadata : dict
+        Describes the run, e.g. the seed, number of universes and a hash of
+        the betas file
+
+    Methods
+    -------
+    write(history, universe, simulation, part=0)
+        Writes the history of one universe or one part of it
+    finish(simulation)
+        Completes a universe once every part of it has been written
+    checkpoint()
+        Makes everything written so far durable and returns what is needed
+        to carry on from this point
+    restore(state)
+        Carries on from a checkpoint, discarding anything written after it
+    close()
+        Finishes writing
+    """
+
+
+    def __init__(self, path, metadata=None):
+        """
+        Parameters
+        ----------
+        path : str
+            Where the output is written
+        metadata : dict, optional
+            Describes the run, must be JSON serialisable
+        """
+
+        self.path = path
+        self.metadata = metadata if metadata is not None else {}
+
+
+    def write(self, history, universe, simulation, part=0):
+        """Writes the history of one universe or one part of it
+
+        Parameters
+        ----------
+        history : History
+            The store holding the simulated history
+        universe : int
+            The position of the universe within the store
+        simulation : int
+            The simulation number to label the output with
+        part : int, optional
+            Identifies the chunk of people of the universe history holds,
+            e.g. the position of its first person in the population
+        """
+
+        raise NotImplementedError
+
+
+    def finish(self, simulation):
+        """Completes a universe once every part of it has been written
+
+        Parameters
+        ----------
+        simulation : int
+            The simulation number the parts were written with
+        """
+
+        pass
+
+
+    def checkpoint(self):
+        """Makes everything written so far durable
+
+        Returns
+        -------
+        dict
+            JSON serialisable state to pass to restore to carry on from here
+        """
+
+        return {}
+
+
+    def restore(self, state):
+        """Carries on from a checkpoint, discarding anything written after it
+
+        Parameters
+        ----------
+        state : dict or None
+            As returned by checkpoint, None to start from scratch
+        """
+
+        pass
+
+
+    def close(self):
+        """Finishes writing"""
+
+        pass
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CsvSink(OutputSink):
+    """
+    A class used to append the wide history of every universe to one CSV file
+
+    The header is written with the first universe and the metadata is saved
+    to a JSON file next to the CSV. A checkpoint records the length of the
+    file so rows appended after it, e.g. by a universe that was cut short,
+    can be cut off again when restoring.
+    """
+
+
+    def __init__(self, path, metadata=None):
+        super().__init__(path, metadata)
+        with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+            json.dump(self.metadata, f, indent=2)
+
+
+    def write(self, history, universe, simulation, part=0):
+        wide = history.wide(universe).reset_index()
+        wide.insert(0, 'simulation', simulation)
+
+        # append out to the file adding a header row if file does not already exist
+        with open(self.path, 'a') as f:
+            wide.to_csv(f, mode='a', index=False, header=f.tell()==0)
+
+
+    def checkpoint(self):
+        size = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'ab') as f:
+                os.fsync(f.fileno())
+                size = f.tell()
+        return {'size': size}
+
+
+    def restore(self, state):
+        if os.path.exists(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(state['size'] if state else 0)
+
+
+class ParquetSink(OutputSink):
+    """
+    A class used to write the wide history as a typed Parquet dataset
+
+    Each universe is written to its own simulation=N partition so a single
+    universe or a few columns can be read back without scanning the rest,
+    each part of a universe being a separate part-P.parquet file in it,
+    where P is the position of the part's first person zero padded so the
+    parts sort, and read back, in the order of the population.
+    Binary outcomes are stored as int8 and continuous scores as float32,
+    missing values are kept as nulls. The metadata is saved both in each
+    file's schema and in a _metadata.json file at the root of the dataset.
+    Each part is written to a hidden temporary file, made durable and
+    renamed into place so a part is either complete or missing, even after
+    a power cut. A checkpoint records the finished universes so the
+    partitions of any other universe, which may have been cut short, are
+    removed when restoring. Requires pyarrow.
+    """
+
+
+    def __init__(self, path, metadata=None):
+        super().__init__(path, metadata)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError("ParquetSink requires pyarrow, install it or use CsvSink instead") from e
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self._finished = set()
+
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, '_metadata.json'), 'w') as f:
+            json.dump(self.metadata, f, indent=2)
+
+
+    def write(self, history, universe, simulation, part=0):
+        pa = self._pa
+        values = history.values[universe]
+
+        arrays = [pa.array(history.mcsid)]
+        for j in range(values.shape[1]):
+            column = pa.array(values[:, j], from_pandas=True)
+            arrays.append(column.cast(pa.int8() if history.binary[j] else pa.float32()))
+        table = pa.Table.from_arrays(arrays, names=['mcsid'] + list(history.columns))
+        table = table.replace_schema_metadata({'lifesim2': json.dumps(self.metadata)})
+
+        partition = os.path.join(self.path, f'simulation={simulation}')
+        if not os.path.isdir(partition):
+            os.makedirs(partition)
+            _fsync_directory(self.path)
+        tmp_file = os.path.join(partition, f'.part-{part:012d}.parquet.tmp')
+        self._pq.write_table(table, tmp_file)
+        with open(tmp_file, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_file, os.path.join(partition, f'part-{part:012d}.parquet'))
+        _fsync_directory(partition)
+
+
+    def finish(self, simulation):
+        self._finished.add(int(simulation))
+
+
+    def checkpoint(self):
+        return {'simulations': sorted(self._finished)}
+
+
+    def restore(self, state):
+        self._finished = set(state['simulations']) if state else set()
+
+        # remove the partitions of universes cut short, including any part left half written
+        for partition in os.listdir(self.path):
+            if partition.startswith('simulation=') and int(partition.split('=')[1]) not in self._finished:
+                shutil.rmtree(os.path.join(self.path, partition))
+
+
+class SummarySink(OutputSink):
+    """
+    A class used to write only the distribution of outcomes across universes
+
+    Each universe is folded into a Summary as it finishes and nothing is
+    kept per person beyond the part being written. The summary table is written to a CSV file on close
+    with the metadata saved to a JSON file next to it, so its size depends
+    on the number of outcomes and subgroups rather than on the cohort. A
+    checkpoint saves the Summary to a new numbered state file, keeping the
+    previous one until a later checkpoint so the state a run last
+    committed to is never overwritten. A shard of a run can defer finishing
+    its universes, keeping the sums behind each universe's averages in the
+    state instead so they can be merged with those of the other shards
+    before any universe is summarised, and then writes no table itself.
+    """
+
+
+    def __init__(self, path, metadata=None, groups=None, defer=False):
+        super().__init__(path, metadata)
+        self.groups = groups
+        self.defer = defer
+        self.summary = None
+        self._checkpoints = 0
+        with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+            json.dump(self.metadata, f, indent=2)
+
+
+    def write(self, history, universe, simulation, part=0):
+        if self.summary is None:
+            self.summary = Summary(history.columns, self.groups)
+        self.summary.accumulate(history, universe, simulation)
+
+
+    def finish(self, simulation):
+        if not self.defer:
+            self.summary.finish(simulation)
+
+
+    def _state_file(self, n):
+        return os.path.splitext(self.path)[0] + f'_state_{n}.pkl'
+
+
+    def checkpoint(self):
+        self._checkpoints += 1
+        state_file = self._state_file(self._checkpoints)
+        with open(state_file, 'wb') as f:
+            pickle.dump(self.summary, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # the state before the previous one can no longer be restored
+        if os.path.exists(self._state_file(self._checkpoints - 2)):
+            os.remove(self._state_file(self._checkpoints - 2))
+        return {'checkpoint': self._checkpoints}
+
+
+    def restore(self, state):
+        self.summary = None
+        self._checkpoints = 0
+        if state:
+            self._checkpoints = state['checkpoint']
+            with open(self._state_file(self._checkpoints), 'rb') as f:
+                self.summary = pickle.load(f)
+
+
+    def close(self):
+        if self.summary is not None and not self.defer:
+            self.summary.table().to_csv(self.path, index=False)
+
+
+class ScenarioSink(SummarySink):
+    """
+    A class used to write the outcomes of scenarios and their differences from the baseline
+
+    Works as SummarySink but folds each universe into a ScenarioSummary,
+    every scenario of a universe being written with the same simulation
+    number and the name of its scenario.
+    """
+
+
+    def __init__(self, path, scenarios, metadata=None, groups=None, defer=False):
+        """
+        Parameters
+        ----------
+        path : str
+            Where the summary table is written
+        scenarios : list of str
+            The name of each scenario, the first being the baseline
+        metadata : dict, optional
+            Describes the run, must be JSON serialisable
+        groups : dict, optional
+            The subgroups to summarise by, defaults to GROUPS
+        defer : bool, optional
+            Whether to leave summarising each universe until shards are merged
+        """
+
+        super().__init__(path, metadata, groups, defer)
+        self.scenarios = list(scenarios)
+
+
+    def write(self, history, universe, simulation, part=0, scenario=None):
+        if self.summary is None:
+            self.summary = ScenarioSummary(history.columns, self.scenarios, self.groups)
+        self.summary.accumulate(history, universe, scenario if scenario is not None else self.scenarios[0], simulation)
+
+
+def read_parquet_output(path, simulations=None, columns=None):
+    """Reads back a history written by ParquetSink
+
+    Only the partitions of the requested simulations and the requested
+    columns are read from disk.
+
+    Parameters
+    ----------
+    path : str
+        The root of the dataset
+    simulations : list of int, optional
+        The simulation numbers to read, all if not given
+    columns : list of str, optional
+        The {variable}_age{age} columns to read, all if not given
+
+    Returns
+    -------
+    DataFrame
+        The history with simulation and mcsid columns followed by the
+        requested columns
+    """
+
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    row_filter = None
+    if simulations is not None:
+        row_filter = ds.field('simulation').isin(list(simulations))
+    if columns is not None:
+        columns = ['simulation', 'mcsid'] + list(columns)
+    history = dataset.to_table(columns=columns, filter=row_filter).to_pandas()
+
+    # the partition column comes last when reading every column
+    history.insert(0, 'simulation', history.pop('simulation'))
+    return history.sort_values('simulation', kind='stable', ignore_index=True)
+
+
+def read_metadata(path):
+    """Reads the run metadata saved by a sink
+
+    Parameters
+    ----------
+    path : str
+        The path the sink was created with
+
+    Returns
+    -------
+    dict
+        The run metadata
+    """
+
+    if os.path.isdir(path):
+        path = os.path.join(path, '_metadata.json')
+    else:
+        path = os.path.splitext(path)[0] + '.json'
+    with open(path) as f:
+        return json.load(f)
@@ -1,6 +1,7 @@
-import pandas as pd
 import numpy as np
-import re
+from SweepPlan import SweepPlan, products
+from History import History
+import instrument
 
 class Person:
     """
@@ -12,14 +13,17 @@ class Person:
     ----------
     mcsid: str
         contains the unique MCSID of the individual to allow linking back to the raw data
-    x : Series
-        Contains all the person specific characteristics
-    betas : DataFrame
+    x : ndarray
+        Contains all the person specific characteristics, positionally 
+        aligned with the rows of betas
+    betas : ndarray
         Contains the regression coefficients for the lifecourse trajectory equations
-    probs : Series
+    probs : ndarray
         Contains random draws to compare the results of the binary equations 
         with in order to decide whether a binary outcome occurred
-    history : DataFrame
+    plan : SweepPlan
+        The compiled positional layout of the sweeps
+    history : History
         Keeps track of the lifecourse trajectory by capturing the evolution of key variables
     social_care : bool
         Records whether the person is currently in social care
@@ -33,7 +37,7 @@ class Person:
     """
 
 
-    def __init__(self, x, betas, probs):
+    def __init__(self, x, betas, probs, plan=None, history=None, universe=0, person=0):
         """
         Parameters
         ----------
@@ -46,28 +50,34 @@ class Person:
             and columns representing dependent (outcome) variables
         probs : Series
             Contains random draws to compare the results of the binary equations 
-            with in order to decide whether a binary outcome occurred
+            with in order to decide whether a binary outcome occurred, laid
+            out as plan.probs_names
+        plan : SweepPlan, optional
+            The compiled positional layout of the sweeps, built from betas
+            if not given, pass one in to share it across many people
+        history : History, optional
+            The store to save the history to, a new single person store
+            is created if not given
+        universe, person : int, optional
+            The universe and person slot of the store to save to, default 0
         """
         
+        self.plan = plan if plan is not None else SweepPlan(betas)
         self.mcsid = x.mcsid_age0
         self.social_care = False
-        self.x = x.drop('mcsid_age0')
-        self.betas = betas
-        self.probs = probs
+        self.x = x.drop('mcsid_age0').values.astype(float)
+        self.betas = betas.values
+        self.probs = probs.values
         
         # save starting conditions to history
-        history_list = []
+        self.history = history if history is not None else History(self.plan, [self.mcsid])
+        self.record = self.history.values[universe, person]
         
         # manually add a variable to capture social care status intialised to 0 
-        row = pd.DataFrame({'mcsid': [self.mcsid], 'mcs_sweep': [1], 'age': [0], 'variable': ['social_care'], 'value': [0]})
-        history_list.append(row)
+        self.record[self.history.social_care_slots[0]] = 0
         
-        # loop through x and add all the age0 variables as starting coditions
-        for name, value in self.x.items():
-            if name.endswith('_age0') or name == 'lifelimiting_age3':
-                row = pd.DataFrame({'mcsid': [self.mcsid], 'mcs_sweep': [1], 'age': [0], 'variable': [name[:-5]], 'value': [value]})
-                history_list.append(row)
-        self.history = pd.concat(history_list, ignore_index=True)
+        # add all the age0 variables as starting coditions
+        self.record[self.history.initial_slots] = self.x[self.plan.initial_positions]
         
 
     def simulate_sweep(self, sweep_num):
@@ -82,11 +92,13 @@ class Person:
         a random number passed in specifically for this outcome through 
         the probs instance variable to calculate whether the outcome 
         occurred. All new variables simulated in the sweep are updated in 
-        x and saved to the history in a one row per variable format. We
+        x and saved to their slots in the history. We
         also simulate if individuals are taken into social care during the 
         sweep, if they are we decrement the cognitive, emotional and conduct
         skills for the current sweep. We assume this is a one-off decrement
         and that individuals do not leave social care once they enter.
+        Which columns, positions and draws each sweep uses are looked up
+        in the compiled plan.
 
         Parameters
         ----------
@@ -96,164 +108,87 @@ class Person:
             age   0   3   5   7   11  14  17
         """
         
-        # calculate the sweep age and previous sweep age based on the sweep number
-        if sweep_num == 2:
-            sweep_age = 3
-            sweep_age_prev = 0
-        elif sweep_num == 3:
-            sweep_age = 5
-            sweep_age_prev = 3
-        elif sweep_num == 4:
-            sweep_age = 7
-            sweep_age_prev = 5
-        elif sweep_num == 5:
-            sweep_age = 11
-            sweep_age_prev = 7
-        elif sweep_num == 6:
-            sweep_age = 14
-            sweep_age_prev = 11
-        elif sweep_num == 7:
-            sweep_age = 17
-            sweep_age_prev = 14
-        else:
+        if sweep_num not in self.plan.sweeps:
             # handle invalid sweep_num values
             raise ValueError(f"Invalid sweep_num value: {sweep_num}\nNote: sweep_num must be between 2 and 7")
+        sweep = self.plan.sweeps[sweep_num]
 
-        # used to store sweep 7 outcomes as these are not currently recorded in x
-        x2 = pd.Series(dtype=float)
+        with instrument.timer('person.sweep', sweep=sweep_num):
+            # outcomes are written back into x except for sweep 7 
+            # whose outcomes are not currently recorded in x
+            outputs = self.x if sweep.in_x else np.zeros(len(sweep.outputs_names))
         
-        # used to retain the sweep level simulated variables that will be added to history
-        history_list = []
-        
-        #####################################################
-        # calculate continuous outcome equations
-        #####################################################
+            #####################################################
+            # calculate continuous outcome equations
+            #####################################################
       
-        # select columns that end with '_age' + str(sweep_age) + ' c'
-        continuous_col_names = self.betas.columns[self.betas.columns.str.endswith('_age' + str(sweep_age) + ' c')]
-        
-        # compute dot product of betas with x
-        continuous_outcomes = np.dot(self.betas[continuous_col_names].values.T, self.x.values)
+            # compute dot product of betas with the predictors of x the sweep uses,
+            # summed in the same order as Cohort
+            betas = self.betas[np.newaxis, sweep.predictors]
+            x = self.x[np.newaxis, np.newaxis, sweep.predictors]
+            continuous_outcomes = products(x, betas[:, :, sweep.continuous_cols])[0, 0]
         
-        # fix the variable names
-        continuous_outcomes = pd.Series(continuous_outcomes, index=continuous_col_names.str.rstrip(' c'))
+            # update continuous outcomes
+            outputs[sweep.continuous_targets] = continuous_outcomes[sweep.continuous_keep]
         
-        # update continuous outcomes in x
-        if sweep_num < 7:
-            self.x.update(continuous_outcomes)
-            # bound con and emo between 0 and 10
-            self.x['con_age' + str(sweep_age)] = max(min(self.x['con_age' + str(sweep_age)], 10), 0)
-            self.x['emo_age' + str(sweep_age)] = max(min(self.x['emo_age' + str(sweep_age)], 10), 0)
-        else:
-            x2 = continuous_outcomes
             # bound con and emo between 0 and 10
-            x2['con_age' + str(sweep_age)] = max(min(x2['con_age' + str(sweep_age)], 10), 0)
-            x2['emo_age' + str(sweep_age)] = max(min(x2['emo_age' + str(sweep_age)], 10), 0)
+            outputs[sweep.con] = max(min(outputs[sweep.con], 10), 0)
+            outputs[sweep.emo] = max(min(outputs[sweep.emo], 10), 0)
             
-        # set income equal to income in previous period
-        if sweep_num < 7:
-            self.x['log_eqv_inc_age' + str(sweep_age)] = self.x['log_eqv_inc_age' + str(sweep_age_prev)]
-        else:
-            x2['log_eqv_inc_age' + str(sweep_age)] = self.x['log_eqv_inc_age' + str(sweep_age_prev)]
-
+            # set income equal to income in previous period
+            outputs[sweep.log_eqv_inc] = self.x[sweep.log_eqv_inc_prev]
    
-        #####################################################
-        # calculate binary outcome equations
-        #####################################################
-
-        # select columns that end with '_age' + str(sweep_age) + ' b'
-        binary_col_names = self.betas.columns[self.betas.columns.str.endswith('_age' + str(sweep_age) + ' b')]
+            #####################################################
+            # calculate binary outcome equations
+            #####################################################
 
-        # compute dot product of betas with x to get the log odds ration
-        xb = np.dot(self.betas[binary_col_names].values.T, self.x.values).astype(float)
+            # compute dot product of betas with x to get the log odds ration
+            x = self.x[np.newaxis, np.newaxis, sweep.predictors]
+            xb = products(x, betas[:, :, sweep.binary_cols])[0, 0]
         
-        # compute threshold probabilities thershold_p using the sigmoid function and the odds ratio
-        threshold_p = 1 / (1 + np.exp(-xb))
+            # compute threshold probabilities thershold_p using the sigmoid function and the odds ratio
+            threshold_p = 1 / (1 + np.exp(-xb))
         
-        # get list of output variable names
-        output_variables = [col_name.replace(' b', '') for col_name in binary_col_names]
+            # create boolean mask of outcomes based on probability thresholds and random probabilities from probs
+            binary_outcomes = (self.probs[sweep.binary_probs] < threshold_p).astype(int)
         
-        # create boolean mask of outcomes based on probability thresholds and random probabilities from probs
-        binary_outcomes = (self.probs[output_variables] < threshold_p).astype(int)
-        
-        # update binary outcomes in x 
-        if sweep_num < 7:
-            self.x.update(binary_outcomes)
-        else:
-            x2 = pd.concat([x2, binary_outcomes])
+            # update binary outcomes
+            outputs[sweep.binary_targets] = binary_outcomes[sweep.binary_keep]
 
-        ######################################################################
-        # calculate social care outcome and adjust other outcomes accordingly
-        ######################################################################
+            ######################################################################
+            # calculate social care outcome and adjust other outcomes accordingly
+            ######################################################################
+        
+            social_care_slot = self.history.social_care_slots[sweep.age]
         
-        if self.social_care:
-            # if already in social care just record to history and take no further action    
-            row = pd.DataFrame({'mcsid': [self.mcsid], 'mcs_sweep': [sweep_num], 'age': [sweep_age], 'variable': ['social_care'], 'value': [1]})
-            history_list.append(row)
-        else:
-            # probability of entering social care is determined by IMD
-            # TODO: sepicify a more plausible social care equation
-            if self.x['imd1_age0'] == 1:
-                social_care_p = 0.00003097
-            elif self.x['imd1_age0'] == 2:
-                social_care_p = 0.00005488
-            elif self.x['imd1_age0'] == 3:
-                social_care_p = 0.00009727
-            elif self.x['imd1_age0'] == 4:
-                social_care_p = 0.00017235
-            elif self.x['imd1_age0'] == 5:
-                social_care_p = 0.00030540
-            elif self.x['imd1_age0'] == 6:
-                social_care_p = 0.00054138
-            elif self.x['imd1_age0'] == 7:
-                social_care_p = 0.00095921
-            elif self.x['imd1_age0'] == 8:
-                social_care_p = 0.00170117
-            elif self.x['imd1_age0'] == 9:
-                social_care_p = 0.00301494
+            if self.social_care:
+                # if already in social care just record to history and take no further action    
+                self.record[social_care_slot] = 1
             else:
-                social_care_p = 0.00533833
+                # probability of entering social care is determined by IMD
+                social_care_p = self.plan.social_care_p(self.x)
             
-            if self.probs['social_care_age'+str(sweep_age)] < social_care_p:
-                # the individual enters social care this sweep
-                # update the instance flag and the history
-                self.social_care = True
-                row = pd.DataFrame({'mcsid': [self.mcsid], 'mcs_sweep': [sweep_num], 'age': [sweep_age], 'variable': ['social_care'], 'value': [1]})
+                if self.probs[sweep.social_care_prob] < social_care_p:
+                    # the individual enters social care this sweep
+                    # update the instance flag, the history slot is left missing
+                    self.social_care = True
                 
-                # adjust zcog, emo and con to make them deteriorate in response to entering social care 
-                # TODO: find some plausible values to adjust by
-                if sweep_num < 7:
-                    self.x['zcog_age' + str(sweep_age)] -= 0.3
-                    self.x['con_age' + str(sweep_age)] += 2
-                    self.x['con_age' + str(sweep_age)] = min(self.x['con_age' + str(sweep_age)], 10)
-                    self.x['emo_age' + str(sweep_age)] += 2
-                    self.x['emo_age' + str(sweep_age)] = min(self.x['emo_age' + str(sweep_age)], 10)
+                    # adjust zcog, emo and con to make them deteriorate in response to entering social care 
+                    # TODO: find some plausible values to adjust by
+                    if sweep.zcog is not None:
+                        outputs[sweep.zcog] -= 0.3
+                    outputs[sweep.con] = min(outputs[sweep.con] + 2, 10)
+                    outputs[sweep.emo] = min(outputs[sweep.emo] + 2, 10)
                 else:
-                    x2['con_age' + str(sweep_age)] += 2
-                    x2['con_age' + str(sweep_age)] = min(x2['con_age' + str(sweep_age)], 10)
-                    x2['emo_age' + str(sweep_age)] += 2
-                    x2['emo_age' + str(sweep_age)] = min(x2['emo_age' + str(sweep_age)], 10)
-            else:
-                # the individual does not enter social care this sweep
-                # update the history accordingly
-                row = pd.DataFrame({'mcsid': [self.mcsid], 'mcs_sweep': [sweep_num], 'age': [sweep_age], 'variable': ['social_care'], 'value': [0]})
-                history_list.append(row)
+                    # the individual does not enter social care this sweep
+                    # update the history accordingly
+                    self.record[social_care_slot] = 0
                 
-        #####################################################
-        # save sweep level outcomes to history
-        #####################################################
+            #####################################################
+            # save sweep level outcomes to history
+            #####################################################
         
-        outputs = self.x if sweep_num < 7 else x2
-        
-        # used to trim the _ageX from the variable name before saving in history
-        trim = 6 if sweep_age > 9 else 5
-          
-        for name, value in outputs.items():
-            if name.endswith('_age' + str(sweep_age)):
-                row = pd.DataFrame({'mcsid': [self.mcsid], 'mcs_sweep': [sweep_num], 'age': [sweep_age], 'variable': [name[:-trim]], 'value': [value]})
-                history_list.append(row)
-
-        self.history = pd.concat([self.history] + history_list, ignore_index=True)
+            self.record[self.history.sweep_slots[sweep_num]] = outputs[sweep.history_positions]
   
         
     def simulate_all_sweeps(self):
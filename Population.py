@@ -0,0 +1,119 @@
+import pandas as pd
+import numpy as np
+
+# keeps the stream the population is sampled from apart from those of RandomStreams
+POPULATION_STREAM = 2
+
+
+class Population:
+    """
+    A class used to scale the MCS cohort up to a synthetic population
+
+    The population is a weighted bootstrap of the MCS individuals, each
+    member being a copy of an individual drawn with probability in
+    proportion to their weight. Nobody is drawn up front, instead the
+    individual each member copies is drawn from a counter based Philox
+    generator set from the member's position in the population, so any
+    chunk of members can be built on its own in memory proportional to the
+    chunk and the population is the same however it is chunked.
+
+    ...
+
+    Attributes
+    ----------
+    people : DataFrame
+        The MCS individuals, one row per person
+    size : int
+        The number of members of the population
+    weights : ndarray
+        The weight of each MCS individual
+    seed : int
+        The seed the population is drawn from
+    expanded : bool
+        Whether the population is a bootstrap rather than the MCS
+        individuals themselves
+
+    Methods
+    -------
+    sources(start, stop)
+        Returns which MCS individual each member start to stop copies
+    chunk(start, stop)
+        Returns members start to stop laid out as the MCS individuals
+    """
+
+
+    def __init__(self, people, size=None, weights=None, seed=0):
+        """
+        Parameters
+        ----------
+        people : DataFrame
+            The MCS individuals, one row per person
+        size : int, optional
+            The number of members, None to use the MCS individuals
+            themselves without resampling
+        weights : str or array_like, optional
+            The column of people or an array holding the weight of each
+            individual, equal weights if not given
+        seed : int, optional
+            The seed the population is drawn from
+        """
+
+        self.people = people
+        self.expanded = size is not None
+        self.size = size if size is not None else len(people)
+        self.seed = seed
+
+        if isinstance(weights, str):
+            weights = people[weights].values
+        self.weights = np.ones(len(people)) if weights is None else np.asarray(weights, dtype=float)
+        if (self.weights < 0).any() or self.weights.sum() <= 0:
+            raise ValueError("Population weights must be non-negative and not all zero")
+        self._cumulative = np.cumsum(self.weights) / self.weights.sum()
+
+
+    def sources(self, start, stop):
+        """Returns which MCS individual each member start to stop copies
+
+        Parameters
+        ----------
+        start, stop : int
+            The range of members
+
+        Returns
+        -------
+        ndarray
+            The row of people each member copies
+        """
+
+        if not self.expanded:
+            return np.arange(start, stop)
+
+        # each member owns one Philox block and uses its first draw
+        key = np.random.SeedSequence(self.seed, spawn_key=(POPULATION_STREAM,)).generate_state(2, np.uint64)
+        counter = np.array([start, 0, 0, 0], dtype=np.uint64)
+        rng = np.random.Generator(np.random.Philox(key=key, counter=counter))
+        draws = rng.random(4 * (stop - start))[::4]
+        return np.minimum(np.searchsorted(self._cumulative, draws, side='right'), len(self.people) - 1)
+
+
+    def chunk(self, start, stop):
+        """Returns members start to stop laid out as the MCS individuals
+
+        Members of an expanded population are given the MCSID of the
+        individual they copy followed by their position in the population.
+
+        Parameters
+        ----------
+        start, stop : int
+            The range of members
+
+        Returns
+        -------
+        DataFrame
+            One row per member
+        """
+
+        chunk = self.people.iloc[self.sources(start, stop)].reset_index(drop=True)
+        if self.expanded:
+            chunk['mcsid_age0'] = chunk['mcsid_age0'].astype(str) + '_' + pd.Series(np.arange(start, stop)).astype(str)
+        return chunk
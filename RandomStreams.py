@@ -0,0 +1,150 @@
+import pandas as pd
+import numpy as np
+
+# the independent streams derived for each universe
+BETAS_STREAM = 0
+PROBS_STREAM = 1
+
+
+class RandomStreams:
+    """
+    A class used to draw the random numbers of the simulation on demand
+
+    Every draw is fixed by the seed, the universe, the sweep, the person and
+    its position within the sweep rather than by the order draws are made
+    in. Each universe gets its own keys derived with SeedSequence and the
+    draws for a sweep come from a counter based Philox generator whose
+    counter is set from the person, so any chunk of people can be drawn
+    directly without drawing anyone before them. Results are therefore
+    identical however the people and universes are split across workers or
+    chunks, and rerunning any subset reproduces the same draws. Nothing is
+    held in memory beyond the draws of the sweep being simulated.
+
+    ...
+
+    Attributes
+    ----------
+    seed : int
+        The seed everything is derived from
+    plan : SweepPlan
+        The compiled positional layout of the sweeps, which fixes the
+        number and order of the draws in each sweep
+
+    Methods
+    -------
+    sim_betas(universe, betas, betas_se)
+        Draws the regression betas of a parameter universe
+    sweep_draws(universe, sweep_num, person_ids)
+        Draws the random numbers each person needs for a sweep
+    probs(universe, person_ids)
+        Returns every draw of the given people laid out as plan.probs_names
+    """
+
+
+    def __init__(self, seed, plan):
+        """
+        Parameters
+        ----------
+        seed : int
+            The seed everything is derived from
+        plan : SweepPlan
+            The compiled positional layout of the sweeps
+        """
+
+        self.seed = seed
+        self.plan = plan
+
+
+    def key(self, universe, stream):
+        """Returns the 128 bit Philox key of one stream of a universe"""
+
+        return np.random.SeedSequence(self.seed, spawn_key=(universe, stream)).generate_state(2, np.uint64)
+
+
+    def sim_betas(self, universe, betas, betas_se):
+        """Draws the regression betas of a parameter universe
+
+        Combines the means and standard errors to create an alternative
+        parameter universe capturing the uncertainty in the estimated
+        equation coefficients.
+
+        Parameters
+        ----------
+        universe : int
+            The universe number
+        betas : DataFrame
+            The regression betas
+        betas_se : DataFrame
+            The standard errors of the regression betas
+
+        Returns
+        -------
+        DataFrame
+            The simulated betas
+        """
+
+        rng = np.random.Generator(np.random.Philox(key=self.key(universe, BETAS_STREAM)))
+        return betas + rng.normal(scale=betas_se.values)
+
+
+    def sweep_draws(self, universe, sweep_num, person_ids):
+        """Draws the random numbers each person needs for a sweep
+
+        Parameters
+        ----------
+        universe : int
+            The universe number
+        sweep_num : int
+            The sweep number
+        person_ids : array_like
+            The position of each person in the full cohort
+
+        Returns
+        -------
+        ndarray
+            num_people x len(plan.sweeps[sweep_num].draws) uniform draws
+        """
+
+        width = len(self.plan.sweeps[sweep_num].draws)
+        key = self.key(universe, PROBS_STREAM)
+
+        # each person owns a fixed run of 4 x 64 bit Philox blocks
+        blocks = -(-width // 4)
+
+        person_ids = np.asarray(person_ids, dtype=np.int64)
+        draws = np.empty((len(person_ids), width))
+
+        # draw each run of consecutive people from a single generator
+        runs = np.split(np.arange(len(person_ids)), np.flatnonzero(np.diff(person_ids) != 1) + 1)
+        for run in runs:
+            if len(run) == 0:
+                continue
+            counter = np.array([person_ids[run[0]] * blocks, sweep_num, 0, 0], dtype=np.uint64)
+            rng = np.random.Generator(np.random.Philox(key=key, counter=counter))
+            draws[run] = rng.random(len(run) * blocks * 4).reshape(len(run), blocks * 4)[:, :width]
+        return draws
+
+
+    def probs(self, universe, person_ids):
+        """Returns every draw of the given people laid out as plan.probs_names
+
+        Materialises the same draws that sweep_draws gives, e.g. to drive
+        Person or to inspect them. Draws that no sweep uses are left missing.
+
+        Parameters
+        ----------
+        universe : int
+            The universe number
+        person_ids : array_like
+            The position of each person in the full cohort
+
+        Returns
+        -------
+        DataFrame
+            One row per person and one column per draw
+        """
+
+        probs = np.full((len(person_ids), len(self.plan.probs_names)), np.nan)
+        for sweep_num, sweep in self.plan.sweeps.items():
+            probs[:, sweep.draws] = self.sweep_draws(universe, sweep_num, person_ids)
+        return pd.DataFrame(probs, columns=self.plan.probs_names)
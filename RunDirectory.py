@@ -0,0 +1,151 @@
+import json
+import os
+import time
+
+
+def write_json_atomic(path, data):
+    """Writes JSON so that readers only ever see the old or the new contents"""
+
+    tmp_file = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+
+class RunDirectory:
+    """
+    A class used to keep the outputs of a run together so it can be resumed
+
+    The directory holds the outputs of every sink and a manifest.json
+    recording the settings the run depends on, such as the seed and a hash
+    of the input files, and the universes that have been completed. A
+    universe only counts as completed once every sink has durably written
+    it and the manifest, which is replaced atomically, lists it along with
+    the state each sink needs to carry on from there. A run that dies part
+    way can be resumed, after checking it has the same settings, from the
+    last completed universe without repeating finished work or tidying up
+    partly written output by hand.
+
+    ...
+
+    Attributes
+    ----------
+    path : str
+        The run directory
+    manifest : dict
+        The settings of the run, the completed universes and the state of
+        each sink as last committed
+
+    Methods
+    -------
+    pending(num_universes)
+        Returns the universes still to be simulated
+    restore(sinks)
+        Returns each sink to the state of the last commit
+    commit(simulation, sinks)
+        Records a universe or several as completed
+    record(name, value)
+        Saves extra information about the run to the manifest
+    """
+
+
+    def __init__(self, path, settings, resume=False):
+        """
+        Parameters
+        ----------
+        path : str
+            The run directory
+        settings : dict
+            The settings the results depend on, e.g. the seed and input
+            hashes, a resumed run must have the same settings
+        resume : bool, optional
+            Whether to carry on from an existing run in path rather than
+            start a new one
+        """
+
+        self.path = path
+        self.manifest_file = os.path.join(path, 'manifest.json')
+
+        if os.path.exists(self.manifest_file):
+            if not resume:
+                raise FileExistsError(f"{path} already holds a run, resume it or choose another run directory")
+            with open(self.manifest_file) as f:
+                self.manifest = json.load(f)
+            # compared as JSON so e.g. tuples match the lists they were saved as, a key only one side has counts as changed
+            settings = json.loads(json.dumps(settings))
+            started = self.manifest['settings']
+            changed = sorted(key for key in set(settings) | set(started)
+                             if key not in settings or key not in started or settings[key] != started[key])
+            if changed:
+                raise ValueError(f"Cannot resume {path}, the run was started with different {changed}")
+        else:
+            if resume:
+                raise FileNotFoundError(f"No run to resume in {path}")
+            os.makedirs(path, exist_ok=True)
+            self.manifest = {'settings': settings,
+                             'started': time.strftime("%Y-%m-%dT%H:%M:%S"),
+                             'completed': [],
+                             'sinks': {}}
+            write_json_atomic(self.manifest_file, self.manifest)
+
+
+    def pending(self, num_universes):
+        """Returns the universes below num_universes still to be simulated"""
+
+        completed = set(self.manifest['completed'])
+        return [n for n in range(num_universes) if n not in completed]
+
+
+    def restore(self, sinks):
+        """Returns each sink to the state of the last commit
+
+        Parameters
+        ----------
+        sinks : dict
+            Maps a name to each OutputSink of the run
+        """
+
+        for name, sink in sinks.items():
+            sink.restore(self.manifest['sinks'].get(name))
+
+
+    def commit(self, simulation, sinks):
+        """Records a universe or several as completed
+
+        Call once every sink has written the universe. The sinks make what
+        they have written durable and the manifest is then replaced in one
+        step, so a crash at any point leaves the previous commit intact.
+
+        Parameters
+        ----------
+        simulation : int or list of int
+            The universe or universes that have been written
+        sinks : dict
+            Maps a name to each OutputSink of the run
+        """
+
+        simulations = {simulation} if isinstance(simulation, int) else set(simulation)
+        states = {name: sink.checkpoint() for name, sink in sinks.items()}
+        self.manifest['completed'] = sorted(set(self.manifest['completed']) | simulations)
+        self.manifest['sinks'] = states
+        self.manifest['updated'] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        write_json_atomic(self.manifest_file, self.manifest)
+
+
+    def record(self, name, value):
+        """Saves extra information about the run to the manifest
+
+        Parameters
+        ----------
+        name : str
+            The key to save value under, must not clash with the keys the
+            manifest already uses
+        value
+            JSON serialisable information, e.g. why the run stopped
+        """
+
+        self.manifest[name] = value
+        self.manifest['updated'] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        write_json_atomic(self.manifest_file, self.manifest)
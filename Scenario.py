@@ -0,0 +1,64 @@
+import numpy as np
+from SweepPlan import SOCIAL_CARE_P
+
+
+class Scenario:
+    """
+    A class used to describe a policy variant of how social care is simulated
+
+    Several scenarios can be simulated in one pass by a Cohort, each
+    scenario of a universe using the same random draws, so the differences
+    between scenarios come from the policy alone rather than from the
+    draws. The defaults reproduce the model as it stands.
+
+    ...
+
+    Attributes
+    ----------
+    name : str
+        Labels the scenario in the outputs
+    social_care_p : ndarray
+        The probability of entering social care in a sweep in each IMD
+        decile 1 to 10
+    zcog_decrement : float
+        How much zcog falls by on entering social care
+    con_emo_increment : float
+        How much con and emo rise by on entering social care, they are
+        still capped at 10
+    """
+
+
+    def __init__(self, name='baseline', social_care_p=None, social_care_scale=1.0, zcog_decrement=0.3,
+                 con_emo_increment=2):
+        """
+        Parameters
+        ----------
+        name : str, optional
+            Labels the scenario in the outputs
+        social_care_p : array_like, optional
+            The probability of entering social care in each IMD decile,
+            defaults to SOCIAL_CARE_P
+        social_care_scale : float, optional
+            Multiplies the probability of entering social care in every decile
+        zcog_decrement : float, optional
+            How much zcog falls by on entering social care
+        con_emo_increment : float, optional
+            How much con and emo rise by on entering social care
+        """
+
+        self.name = name
+        social_care_p = SOCIAL_CARE_P if social_care_p is None else np.asarray(social_care_p, dtype=float)
+        if social_care_p.shape != SOCIAL_CARE_P.shape:
+            raise ValueError(f"social_care_p needs one probability per IMD decile, got {social_care_p.shape}")
+        self.social_care_p = social_care_p * social_care_scale
+        self.zcog_decrement = zcog_decrement
+        self.con_emo_increment = con_emo_increment
+
+
+    def settings(self):
+        """Returns the scenario as JSON serialisable settings"""
+
+        return {'name': self.name,
+                'social_care_p': self.social_care_p.tolist(),
+                'zcog_decrement': self.zcog_decrement,
+                'con_emo_increment': self.con_emo_increment}
@@ -0,0 +1,664 @@
+import pandas as pd
+import numpy as np
+
+# the quantiles reported for each outcome, the median and a 95% interval
+QUANTILES = [0.025, 0.5, 0.975]
+
+# the sums behind each average are kept exactly in whole multiples of
+# 1 / FIXED_POINT, so they are the same however the people are chunked or
+# sharded rather than depending on the order floats are added in
+FIXED_POINT = 2**40
+
+
+def _fixed_point(values):
+    """Splits each value into pieces whose sums float64 holds exactly
+
+    Values are rounded to a multiple of 1 / FIXED_POINT and split into their
+    whole part and two 20 bit pieces of their fraction, so any sum of up to
+    2**33 pieces is exact in whatever order it is added up.
+    """
+
+    whole = np.floor(values)
+    fraction = np.rint((values - whole) * FIXED_POINT)
+    high = np.floor(fraction / 2**20)
+    return np.hstack([whole, high, fraction - high * 2**20])
+
+
+def _exact(sums):
+    """Combines sums of the pieces from _fixed_point into ints counting 1 / FIXED_POINT"""
+
+    whole, high, low = np.split(sums.astype(np.int64).astype(object), 3, axis=-1)
+    return whole * FIXED_POINT + high * 2**20 + low
+
+
+def in_social_care(history, values):
+    """Returns whether each person is in social care by age 17
+
+    Social care status is missing in the sweep someone enters care so
+    anything other than 0 at age 17 means they are in care.
+    """
+
+    return (values[:, history.social_care_slots[17]] != 0).astype(float)
+
+
+# the subgroups outcomes are summarised by as well as the whole cohort,
+# each is a history column, a list of dummy columns or a function of the
+# history and a universe's values returning each person's group
+GROUPS = {
+    'imd1': 'imd1_age0',
+    'country': ['country2_age0', 'country3_age0', 'country4_age0'],
+    'social_care': in_social_care,
+}
+
+
+class Moments:
+    """
+    A class used to keep a running mean and variance of a vector of statistics
+
+    Uses Welford's online algorithm so each new observation is added in
+    constant memory and two sets of moments can be merged exactly.
+    Missing values are skipped separately for every element.
+
+    ...
+
+    Attributes
+    ----------
+    count : ndarray
+        The number of observations of each element
+    mean : ndarray
+        The running mean of each element
+    m2 : ndarray
+        The running sum of squared differences from the mean
+    """
+
+
+    def __init__(self, size):
+        """
+        Parameters
+        ----------
+        size : int
+            The number of elements
+        """
+
+        self.count = np.zeros(size)
+        self.mean = np.zeros(size)
+        self.m2 = np.zeros(size)
+
+
+    def add(self, values):
+        """Adds one observation of every element"""
+
+        seen = ~np.isnan(values)
+        self.count += seen
+        delta = np.where(seen, values - self.mean, 0)
+        self.mean += np.where(seen, delta / np.maximum(self.count, 1), 0)
+        self.m2 += np.where(seen, delta * (values - self.mean), 0)
+
+
+    def merge(self, other):
+        """Adds the observations summarised by other"""
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            share = np.where(count > 0, other.count / count, 0)
+        self.mean = self.mean + delta * share
+        self.m2 = self.m2 + other.m2 + delta**2 * self.count * share
+        self.count = count
+
+
+    def sd(self):
+        """Returns the sample standard deviation of each element"""
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, np.sqrt(self.m2 / (self.count - 1)), np.nan)
+
+
+class QuantileSketch:
+    """
+    A class used to estimate quantiles of a vector of statistics in bounded memory
+
+    A mergeable compactor sketch. Observations are kept exactly until a
+    level holds k of them, then it is sorted and every other value is
+    promoted to the next level with double the weight. Memory is about
+    2k log2(n / k) values per element, quantiles are exact while fewer than
+    k observations have been added and sketches built on different
+    machines can be merged.
+
+    ...
+
+    Attributes
+    ----------
+    k : int
+        The number of values a level holds before it is compacted
+    levels : list of ndarray
+        The values held at each level, level i values have weight 2**i
+    """
+
+
+    def __init__(self, size, k=256):
+        """
+        Parameters
+        ----------
+        size : int
+            The number of elements
+        k : int, optional
+            The number of values a level holds before it is compacted
+        """
+
+        self.k = k
+        self.levels = [np.empty((0, size))]
+        self._compactions = [0]
+
+
+    def add(self, values):
+        """Adds one observation of every element"""
+
+        self.levels[0] = np.vstack([self.levels[0], values])
+        self._compact()
+
+
+    def merge(self, other):
+        """Adds the observations summarised by other"""
+
+        for i, level in enumerate(other.levels):
+            if i == len(self.levels):
+                self.levels.append(np.empty((0, level.shape[1])))
+                self._compactions.append(0)
+            self.levels[i] = np.vstack([self.levels[i], level])
+        self._compact()
+
+
+    def _compact(self):
+        """Promotes half of any full level to the next level"""
+
+        i = 0
+        while i < len(self.levels):
+            level = self.levels[i]
+            if len(level) >= self.k:
+                if i + 1 == len(self.levels):
+                    self.levels.append(np.empty((0, level.shape[1])))
+                    self._compactions.append(0)
+
+                # alternate which half is kept so the errors cancel out
+                paired = len(level) - len(level) % 2
+                ordered = np.sort(level[:paired], axis=0)
+                offset = self._compactions[i] % 2
+                self._compactions[i] += 1
+                self.levels[i + 1] = np.vstack([self.levels[i + 1], ordered[offset::2]])
+                self.levels[i] = level[paired:]
+            i += 1
+
+
+    def quantiles(self, qs):
+        """Returns the estimated quantiles of each element
+
+        Parameters
+        ----------
+        qs : list of float
+            The quantiles to estimate between 0 and 1
+
+        Returns
+        -------
+        ndarray
+            len(qs) x size estimates, NaN for elements with no observations
+        """
+
+        values = np.vstack(self.levels)
+        weights = np.concatenate([np.full(len(level), 2.0**i) for i, level in enumerate(self.levels)])
+
+        # sort each element separately, missing values sort last and carry no weight
+        order = np.argsort(values, axis=0)
+        values = np.take_along_axis(values, order, axis=0)
+        weights = np.where(np.isnan(values), 0, weights[order])
+        cumulative = np.cumsum(weights, axis=0)
+
+        estimates = np.full((len(qs), values.shape[1]), np.nan)
+        if len(values) == 0:
+            return estimates
+        total = cumulative[-1]
+        for j, q in enumerate(qs):
+            position = np.minimum((cumulative < q * total).sum(axis=0), len(values) - 1)
+            estimates[j] = np.where(total > 0, values[position, np.arange(values.shape[1])], np.nan)
+        return estimates
+
+
+class Summary:
+    """
+    A class used to summarise the distribution of outcomes across universes
+
+    Each universe is added as soon as it has been simulated. Its outcomes
+    are averaged over the people in the whole cohort and in each subgroup,
+    giving e.g. the prevalence of obesity at 17 in each IMD decile, and
+    those averages are folded into running moments and a quantile sketch
+    across universes. Memory use depends on the number of columns and
+    groups but not on the number of people, so full histories never need
+    to be kept or written out. A universe too large to hold at once can be
+    accumulated chunk by chunk of people, only the sums and counts behind
+    its averages being kept until it is finished. The sums are exact, each
+    value being rounded to a multiple of 1 / FIXED_POINT, so the averages
+    do not depend on how the people were chunked or sharded.
+
+    ...
+
+    Attributes
+    ----------
+    columns : Index
+        The {variable}_age{age} history columns summarised
+    groups : dict
+        The subgroups summarised, see GROUPS
+    k : int
+        The size of the quantile sketches
+    cells : dict
+        Maps each (group, level) to the Moments and QuantileSketch of the
+        averages of every column across universes
+
+    Methods
+    -------
+    add(history, universe)
+        Adds one simulated universe
+    accumulate(history, universe, simulation)
+        Adds one chunk of people of a simulated universe
+    finish(simulation)
+        Adds a universe once every chunk of it has been accumulated
+    averages(simulation)
+        Returns the averages of an accumulated universe without adding it
+    add_averages(averages)
+        Adds a universe given the averages of every group
+    unfinished()
+        Returns the universes accumulated but not yet finished
+    standard_errors(columns, group='all', level='all')
+        Returns the Monte Carlo standard error of the mean of columns
+    merge(other)
+        Adds the universes summarised by another Summary
+    table()
+        Returns the summary as one row per group, level and column
+    """
+
+
+    def __init__(self, columns, groups=None, k=256):
+        """
+        Parameters
+        ----------
+        columns : Index
+            The history columns to summarise
+        groups : dict, optional
+            The subgroups to summarise by, defaults to GROUPS
+        k : int, optional
+            The size of the quantile sketches
+        """
+
+        self.columns = pd.Index(columns)
+        self.groups = GROUPS if groups is None else groups
+        self.k = k
+        self.cells = {}
+        self._pending = {}
+
+
+    def _labels(self, spec, history, values):
+        """Returns the group of each person, NaN for people in no group
+
+        values holds every column of the history of one universe.
+        """
+
+        if callable(spec):
+            return spec(history, values)
+        if isinstance(spec, str):
+            return values[:, history.columns.get_loc(spec)]
+
+        # a set of dummy variables is labelled by whichever dummy is set
+        # with 0 for the reference category
+        dummies = values[:, history.columns.get_indexer(spec)]
+        return np.where(dummies.any(axis=1), dummies.argmax(axis=1) + 1, 0).astype(float)
+
+
+    def _add_cell(self, key, averages):
+        if key not in self.cells:
+            self.cells[key] = (Moments(len(self.columns)), QuantileSketch(len(self.columns), self.k))
+        moments, sketch = self.cells[key]
+        moments.add(averages)
+        sketch.add(averages)
+
+
+    def add(self, history, universe):
+        """Adds one simulated universe
+
+        Parameters
+        ----------
+        history : History
+            The store holding the simulated history
+        universe : int
+            The position of the universe within the store
+        """
+
+        self.accumulate(history, universe, None)
+        self.finish(None)
+
+
+    def _tally(self, sums, key, totals, counts):
+        if key in sums:
+            sums[key][0] += totals
+            sums[key][1] += counts
+        else:
+            sums[key] = [totals, counts]
+
+
+    def accumulate(self, history, universe, simulation):
+        """Adds one chunk of people of a simulated universe
+
+        Parameters
+        ----------
+        history : History
+            The store holding the simulated history of the chunk
+        universe : int
+            The position of the universe within the store
+        simulation : int
+            The simulation number the chunk belongs to
+        """
+
+        record = history.values[universe]
+        values = record[:, history.columns.get_indexer(self.columns)].astype(float)
+        seen = ~np.isnan(values)
+        pieces = _fixed_point(np.where(seen, values, 0))
+
+        sums = self._pending.setdefault(simulation, {})
+        self._tally(sums, ('all', 'all'), _exact(pieces.sum(axis=0)), seen.sum(axis=0))
+
+        for name, spec in self.groups.items():
+            labels = self._labels(spec, history, record)
+            levels, codes = np.unique(labels[~np.isnan(labels)], return_inverse=True)
+            members = np.zeros((len(levels), len(labels)))
+            members[codes, np.flatnonzero(~np.isnan(labels))] = 1
+
+            # totals and counts of every column in every group as two matrix products
+            for level, totals, counts in zip(levels, _exact(members @ pieces), (members @ seen).astype(np.int64)):
+                self._tally(sums, (name, level), totals, counts)
+
+
+    def finish(self, simulation):
+        """Adds a universe once every chunk of it has been accumulated
+
+        Parameters
+        ----------
+        simulation : int
+            The simulation number passed to accumulate
+        """
+
+        self.add_averages(self.averages(simulation))
+
+
+    def averages(self, simulation):
+        """Returns the averages of an accumulated universe without adding it
+
+        The universe is no longer pending afterwards.
+
+        Parameters
+        ----------
+        simulation : int
+            The simulation number passed to accumulate
+
+        Returns
+        -------
+        dict
+            Maps each (group, level) to the averages of every column
+        """
+
+        # dividing ints rounds each average correctly, a column nobody has a value for is NaN
+        return {key: np.array([total / (count * FIXED_POINT) if count else np.nan
+                               for total, count in zip(totals, counts.tolist())])
+                for key, (totals, counts) in self._pending.pop(simulation, {}).items()}
+
+
+    def add_averages(self, averages):
+        """Adds a universe given the averages of every group
+
+        Parameters
+        ----------
+        averages : dict
+            Maps each (group, level) to the averages of every column, e.g.
+            as returned by averages or the differences between two such
+        """
+
+        for key, values in averages.items():
+            self._add_cell(key, values)
+
+
+    def unfinished(self):
+        """Returns the simulation numbers accumulated but not yet finished"""
+
+        return sorted(self._pending)
+
+
+    def standard_errors(self, columns, group='all', level='all'):
+        """Returns the Monte Carlo standard error of the mean of columns
+
+        This is the standard deviation of a column's average across
+        universes over the square root of the number of universes, so it
+        shrinks as more universes are added.
+
+        Parameters
+        ----------
+        columns : list of str
+            The history columns
+        group, level : str or float, optional
+            The group and level of the averages, the whole cohort by default
+
+        Returns
+        -------
+        ndarray
+            The standard error of each column, NaN with fewer than two universes
+        """
+
+        positions = self.columns.get_indexer(columns)
+        if (positions < 0).any():
+            raise ValueError(f"Not summarised: {list(pd.Index(columns)[positions < 0])}")
+        if (group, level) not in self.cells:
+            return np.full(len(positions), np.nan)
+
+        moments = self.cells[(group, level)][0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return moments.sd()[positions] / np.sqrt(moments.count[positions])
+
+
+    def merge(self, other):
+        """Adds the universes summarised by another Summary
+
+        Universes other has accumulated but not finished are added to the
+        sums of the same universes here, so the chunks of people of a
+        universe can be accumulated in different runs and finished once
+        they have all been merged.
+
+        Parameters
+        ----------
+        other : Summary
+            A summary of the same columns, e.g. from another worker or run
+        """
+
+        if not self.columns.equals(other.columns):
+            raise ValueError("Can only merge summaries of the same columns")
+
+        for simulation, other_sums in other._pending.items():
+            sums = self._pending.setdefault(simulation, {})
+            for key, (totals, counts) in other_sums.items():
+                self._tally(sums, key, totals.copy(), counts.copy())
+
+        for key, (moments, sketch) in other.cells.items():
+            if key not in self.cells:
+                self.cells[key] = (Moments(len(self.columns)), QuantileSketch(len(self.columns), self.k))
+            self.cells[key][0].merge(moments)
+            self.cells[key][1].merge(sketch)
+
+
+    def table(self):
+        """Returns the summary as one row per group, level and column
+
+        Returns
+        -------
+        DataFrame
+            The number of universes, the mean and standard deviation across
+            universes and the QUANTILES of the average of each column
+        """
+
+        variables = self.columns.str.replace(r'_age\d+$', '', regex=True)
+        ages = self.columns.str.extract(r'_age(\d+)$', expand=False).astype(int)
+
+        # the whole cohort then each group in turn by level, however the people were chunked
+        order = {group: i for i, group in enumerate(['all'] + list(self.groups))}
+        cells = sorted(self.cells.items(), key=lambda cell: (order.get(cell[0][0], len(order)), str(cell[0][0]),
+                                                             0 if isinstance(cell[0][1], str) else cell[0][1]))
+
+        tables = []
+        for (group, level), (moments, sketch) in cells:
+            table = pd.DataFrame({'group': group,
+                                  'level': level if isinstance(level, str) else f'{level:g}',
+                                  'variable': variables,
+                                  'age': ages,
+                                  'universes': moments.count.astype(int),
+                                  'mean': np.where(moments.count > 0, moments.mean, np.nan),
+                                  'sd': moments.sd()})
+            for q, estimates in zip(QUANTILES, sketch.quantiles(QUANTILES)):
+                table[f'q{q:g}'] = estimates
+            tables.append(table)
+        return pd.concat(tables, ignore_index=True)
+
+
+class ScenarioSummary:
+    """
+    A class used to summarise scenarios and their differences from a baseline
+
+    Every scenario of a universe is simulated with the same random draws,
+    so the difference between a scenario's averages and the baseline's
+    within each universe is free of most of the noise of the draws and the
+    differences settle down in far fewer universes than comparing separate
+    runs would need. The differences are summarised across universes just
+    as the outcomes of each scenario are. A universe simulated with both
+    ordinary and antithetic draws is accumulated as one, so its averages
+    are the mean of the pair.
+
+    ...
+
+    Attributes
+    ----------
+    scenarios : list of str
+        The name of each scenario, the first being the baseline
+    levels : dict
+        Maps each scenario to the Summary of its outcomes
+    differences : dict
+        Maps each scenario other than the baseline to the Summary of its
+        outcomes minus those of the baseline in the same universe
+
+    Methods
+    -------
+    accumulate(history, universe, scenario, simulation)
+        Adds one chunk of people of a scenario of a simulated universe
+    finish(simulation)
+        Adds a universe once every scenario and chunk has been accumulated
+    unfinished()
+        Returns the universes accumulated but not yet finished
+    merge(other)
+        Adds the universes summarised by another ScenarioSummary
+    table()
+        Returns the summary as one row per scenario, measure, group, level and column
+    """
+
+
+    def __init__(self, columns, scenarios, groups=None, k=256):
+        """
+        Parameters
+        ----------
+        columns : Index
+            The history columns to summarise
+        scenarios : list of str
+            The name of each scenario, the first being the baseline
+        groups : dict, optional
+            The subgroups to summarise by, defaults to GROUPS
+        k : int, optional
+            The size of the quantile sketches
+        """
+
+        self.scenarios = list(scenarios)
+        self.levels = {name: Summary(columns, groups, k) for name in self.scenarios}
+        self.differences = {name: Summary(columns, groups, k) for name in self.scenarios[1:]}
+
+
+    def accumulate(self, history, universe, scenario, simulation):
+        """Adds one chunk of people of a scenario of a simulated universe
+
+        Parameters
+        ----------
+        history : History
+            The store holding the simulated history of the chunk
+        universe : int
+            The position of the universe within the store
+        scenario : str
+            The scenario the universe was simulated under
+        simulation : int
+            The simulation number the chunk belongs to
+        """
+
+        self.levels[scenario].accumulate(history, universe, simulation)
+
+
+    def finish(self, simulation):
+        """Adds a universe once every scenario and chunk has been accumulated
+
+        Parameters
+        ----------
+        simulation : int
+            The simulation number passed to accumulate
+        """
+
+        averages = {name: summary.averages(simulation) for name, summary in self.levels.items()}
+        baseline = averages[self.scenarios[0]]
+        for name in self.scenarios:
+            self.levels[name].add_averages(averages[name])
+            if name in self.differences:
+                # groups missing from either scenario have no difference
+                self.differences[name].add_averages({key: values - baseline[key]
+                                                     for key, values in averages[name].items() if key in baseline})
+
+
+    def unfinished(self):
+        """Returns the simulation numbers accumulated but not yet finished"""
+
+        return sorted(set().union(*[summary.unfinished() for summary in self.levels.values()]))
+
+
+    def merge(self, other):
+        """Adds the universes summarised by another ScenarioSummary
+
+        Parameters
+        ----------
+        other : ScenarioSummary
+            A summary of the same scenarios and columns
+        """
+
+        if self.scenarios != other.scenarios:
+            raise ValueError("Can only merge summaries of the same scenarios")
+
+        for name, summary in self.levels.items():
+            summary.merge(other.levels[name])
+        for name, summary in self.differences.items():
+            summary.merge(other.differences[name])
+
+
+    def table(self):
+        """Returns the summary as one row per scenario, measure, group, level and column
+
+        Returns
+        -------
+        DataFrame
+            As Summary.table with the scenario and whether the row
+            summarises its outcomes (level) or their difference from the
+            baseline (difference)
+        """
+
+        tables = []
+        for measure, summaries in [('level', self.levels), ('difference', self.differences)]:
+            for name, summary in summaries.items():
+                if summary.cells:
+                    table = summary.table()
+                    table.insert(0, 'measure', measure)
+                    table.insert(0, 'scenario', name)
+                    tables.append(table)
+        return pd.concat(tables, ignore_index=True)
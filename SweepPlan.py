@@ -0,0 +1,294 @@
+import pandas as pd
+import numpy as np
+
+# sweep number -> (sweep age, previous sweep age)
+SWEEP_AGES = {2: (3, 0), 3: (5, 3), 4: (7, 5), 5: (11, 7), 6: (14, 11), 7: (17, 14)}
+
+# probability of entering social care in a sweep by IMD decile 1 to 10
+# TODO: sepicify a more plausible social care equation
+SOCIAL_CARE_P = np.array([0.00003097, 0.00005488, 0.00009727, 0.00017235, 0.00030540,
+                          0.00054138, 0.00095921, 0.00170117, 0.00301494, 0.00533833])
+
+
+def products(x, betas):
+    """Returns the predictors of each person times the betas of their universe
+
+    Each outcome is summed over the predictors one at a time in order.
+    einsum chooses how to loop from the shapes and memory layout of its
+    operands, so they are made contiguous and a lone outcome is padded to
+    two to keep that order however many people or universes there are,
+    down to the single person Person simulates. The outcomes of a person
+    are then the same whichever way they are simulated.
+
+    Parameters
+    ----------
+    x : ndarray
+        num_universes x num_people x num_predictors values of the predictors
+    betas : ndarray
+        num_universes x num_predictors x num_outcomes regression coefficients
+
+    Returns
+    -------
+    ndarray
+        num_universes x num_people x num_outcomes
+    """
+
+    num_outcomes = betas.shape[2]
+    if num_outcomes == 1:
+        betas = np.concatenate([betas, np.zeros_like(betas)], axis=2)
+    return np.einsum('upv,uvo->upo', np.ascontiguousarray(x), np.ascontiguousarray(betas))[:, :, :num_outcomes]
+
+
+class Sweep:
+    """
+    A class used to hold the positional layout of the equations for one MCS sweep
+
+    Outcomes of sweeps 2-6 are written straight back into x so all target
+    positions index x. Sweep 7 outcomes are not held in x, instead they are
+    written to a separate outputs vector laid out as the continuous
+    outcomes, then income, then the binary outcomes, and the target
+    positions index that vector.
+
+    ...
+
+    Attributes
+    ----------
+    sweep_num : int
+        The sweep number
+    age : int
+        The age of the cohort at this sweep
+    age_prev : int
+        The age of the cohort at the previous sweep
+    in_x : bool
+        Whether the outcomes of this sweep are written back into x
+    outputs_names : Index
+        The names of the outputs vector when in_x is False
+    continuous_cols : ndarray
+        The columns of betas holding the continuous equations
+    continuous_names : Index
+        The outcome variable names of the continuous equations
+    continuous_keep, continuous_targets : ndarray
+        Which continuous outcomes are stored and their target positions
+    binary_cols : ndarray
+        The columns of betas holding the binary equations
+    binary_names : Index
+        The outcome variable names of the binary equations
+    binary_probs : ndarray
+        The positions in probs of the random draws for each binary equation
+    binary_keep, binary_targets : ndarray
+        Which binary outcomes are stored and their target positions
+    predictors : ndarray
+        The positions in x of the predictors with a nonzero coefficient in
+        any equation of the sweep, the equations are evaluated over these only
+    con, emo, zcog, log_eqv_inc : int
+        Target positions of the outcomes adjusted outside the equations,
+        zcog is None when it is not simulated in this sweep
+    log_eqv_inc_prev : int
+        The position in x of income at the previous sweep
+    social_care_prob : int
+        The position in probs of the random draw for entering social care
+    draws : ndarray
+        The positions in probs of every random draw the sweep uses, the
+        binary equations followed by entering social care
+    history_positions : ndarray
+        The target positions of the variables saved to history
+    history_names : Index
+        The names, without the _ageX suffix, of the variables saved to history
+    """
+
+
+    def __init__(self, sweep_num, x_names, betas_names, probs_names, nonzero=None):
+        """
+        Parameters
+        ----------
+        sweep_num : int
+            The sweep to lay out, between 2 and 7
+        x_names : Index
+            The names of the person characteristics, the rows of betas
+        betas_names : Index
+            The names of the equations, the columns of betas
+        probs_names : Index
+            The names of the random draws
+        nonzero : ndarray, optional
+            num_vars x num_outcomes mask of the coefficients that can be
+            nonzero, every predictor is kept if not given
+        """
+
+        if sweep_num not in SWEEP_AGES:
+            # handle invalid sweep_num values
+            raise ValueError(f"Invalid sweep_num value: {sweep_num}\nNote: sweep_num must be between 2 and 7")
+
+        self.sweep_num = sweep_num
+        self.age, self.age_prev = SWEEP_AGES[sweep_num]
+        self.in_x = sweep_num < 7
+        suffix = '_age' + str(self.age)
+
+        # select the equations of this sweep and fix the variable names
+        self.continuous_cols = np.flatnonzero(betas_names.str.endswith(suffix + ' c'))
+        self.continuous_names = betas_names[self.continuous_cols].str.rstrip(' c')
+        self.binary_cols = np.flatnonzero(betas_names.str.endswith(suffix + ' b'))
+        self.binary_names = betas_names[self.binary_cols].str.replace(' b', '')
+        self.binary_probs = probs_names.get_indexer(self.binary_names)
+        if (self.binary_probs < 0).any():
+            raise ValueError(f"No random draws for {list(self.binary_names[self.binary_probs < 0])}")
+        self.social_care_prob = probs_names.get_loc('social_care' + suffix)
+        self.draws = np.append(self.binary_probs, self.social_care_prob)
+
+        # most predictors only appear in the equations of some sweeps
+        equations = np.append(self.continuous_cols, self.binary_cols)
+        if nonzero is None:
+            self.predictors = np.arange(len(x_names))
+        else:
+            self.predictors = np.flatnonzero(nonzero[:, equations].any(axis=1))
+        self.log_eqv_inc_prev = x_names.get_loc('log_eqv_inc_age' + str(self.age_prev))
+
+        if self.in_x:
+            # outcomes that have no place in x are dropped as Series.update does
+            targets = x_names
+            self.outputs_names = None
+            continuous = x_names.get_indexer(self.continuous_names)
+            binary = x_names.get_indexer(self.binary_names)
+        else:
+            targets = pd.Index(list(self.continuous_names) + ['log_eqv_inc' + suffix] + list(self.binary_names))
+            self.outputs_names = targets
+            continuous = np.arange(len(self.continuous_names))
+            binary = len(self.continuous_names) + 1 + np.arange(len(self.binary_names))
+
+        self.continuous_keep = np.flatnonzero(continuous >= 0)
+        self.continuous_targets = continuous[self.continuous_keep]
+        self.binary_keep = np.flatnonzero(binary >= 0)
+        self.binary_targets = binary[self.binary_keep]
+
+        # outcomes adjusted outside the equations, sweep 7 has no zcog
+        self.con = targets.get_loc('con' + suffix)
+        self.emo = targets.get_loc('emo' + suffix)
+        self.zcog = targets.get_loc('zcog' + suffix) if self.in_x else None
+        self.log_eqv_inc = targets.get_loc('log_eqv_inc' + suffix)
+
+        # variables saved to history with the _ageX trimmed from the name
+        self.history_positions = np.flatnonzero(targets.str.endswith(suffix))
+        self.history_names = targets[self.history_positions].str[:-len(suffix)]
+
+
+    def covers(self, betas):
+        """Returns whether every nonzero coefficient of the sweep is on a kept predictor
+
+        Parameters
+        ----------
+        betas : ndarray
+            Coefficients with predictors and equations on the last two axes
+
+        Returns
+        -------
+        bool
+            False if any pruned predictor has a nonzero coefficient
+        """
+
+        pruned = np.ones(betas.shape[-2], dtype=bool)
+        pruned[self.predictors] = False
+        equations = np.append(self.continuous_cols, self.binary_cols)
+        return not np.any(betas[..., pruned, :][..., equations])
+
+
+class SweepPlan:
+    """
+    A class used to hold the compiled positional layout of every MCS sweep
+
+    All the string matching needed to find which betas columns, x positions
+    and random draws each sweep uses is done once here rather than every
+    time a sweep is simulated. The betas are padded with zeros for every
+    predictor of every equation but each sweep only uses a few of them, so
+    the predictors that have a nonzero coefficient in a sweep's equations
+    are also found once here and the sweep is evaluated over those alone.
+    Passing the standard errors of betas as support as well keeps every
+    predictor that any simulated draw of betas can use, so one plan can be
+    shared by all the simulated betas universes.
+
+    ...
+
+    Attributes
+    ----------
+    x_names : Index
+        The names of the person characteristics, the rows of betas
+    betas_names : Index
+        The names of the equations, the columns of betas
+    probs_names : Index
+        The names of the random draws, one per binary outcome plus one for
+        entering social care at each sweep
+    imd : int
+        The position in x of the IMD decile
+    initial_positions : ndarray
+        The positions in x of the starting conditions saved to history
+    initial_names : Index
+        The names, without the _ageX suffix, of the starting conditions
+    sweeps : dict
+        Maps each sweep number 2 to 7 to its Sweep layout
+    """
+
+
+    def __init__(self, betas, probs_names=None, support=None):
+        """
+        Parameters
+        ----------
+        betas : DataFrame
+            Contains the regression coefficients for the lifecourse trajectory
+            equations with rows representing independent variables coefficients
+            and columns representing dependent (outcome) variables
+        probs_names : Index, optional
+            The names of the random draws, defaults to the binary outcomes
+            of betas and the social care draws in sorted order
+        support : list of DataFrame, optional
+            Frames laid out as betas whose nonzero entries mark every
+            coefficient that can be nonzero, e.g. betas and their standard
+            errors or every simulated draw, defaults to betas alone
+        """
+
+        self.x_names = betas.index
+        self.betas_names = betas.columns
+
+        if probs_names is None:
+            # extract binary outcome variable names from the equations
+            # and add columns to represent entering into social care at various ages
+            probs_names = self.betas_names[self.betas_names.str.endswith(' b')].str.replace(' b$', '', regex=True)
+            probs_names = probs_names.union(['social_care_age' + str(age) for age, _ in SWEEP_AGES.values()])
+        self.probs_names = pd.Index(probs_names)
+
+        self.imd = self.x_names.get_loc('imd1_age0')
+        initial = self.x_names.str.endswith('_age0') | (self.x_names == 'lifelimiting_age3')
+        self.initial_positions = np.flatnonzero(initial)
+        self.initial_names = self.x_names[self.initial_positions].str[:-5]
+
+        support = [betas] if support is None else support
+        nonzero = np.any([np.asarray(frame.values) != 0 for frame in support], axis=0)
+
+        self.sweeps = {sweep_num: Sweep(sweep_num, self.x_names, self.betas_names, self.probs_names, nonzero)
+                       for sweep_num in SWEEP_AGES}
+
+
+    def social_care_p(self, x, table=None):
+        """Returns the probability of entering social care
+
+        The probability is determined by IMD, anything outside deciles 1
+        to 9 is treated as decile 10.
+
+        Parameters
+        ----------
+        x : ndarray
+            Person characteristics with variables on the last axis
+        table : ndarray, optional
+            The probability in each decile, defaults to SOCIAL_CARE_P, or
+            num_universes x 10 probabilities to use a different table in
+            each universe of a num_universes x num_people x num_vars x
+
+        Returns
+        -------
+        ndarray
+            The probability for each person
+        """
+
+        imd = x[..., self.imd]
+        decile = np.where(np.isin(imd, np.arange(1, 10)), imd, 10).astype(int)
+        table = SOCIAL_CARE_P if table is None else np.asarray(table)
+        if table.ndim == 1:
+            return table[decile - 1]
+        return table[np.arange(len(table))[:, np.newaxis], decile - 1]
@@ -0,0 +1,238 @@
+import numpy as np
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from Cohort import Cohort
+from History import History
+from RandomStreams import RandomStreams
+import instrument
+
+# the plan, MCSIDs and open memory mapped arrays of the current worker process
+_worker = {}
+
+
+def _attach(plan, mcsid, paths, streams, universes, person_ids, dtype, scenarios, antithetic, profile=False):
+    """Opens the memory mapped inputs and output once per worker process"""
+
+    if profile:
+        instrument.enable()
+    _worker['plan'] = plan
+    _worker['mcsid'] = mcsid
+    _worker['streams'] = streams
+    _worker['universes'] = universes
+    _worker['person_ids'] = person_ids
+    _worker['dtype'] = dtype
+    _worker['scenarios'] = scenarios
+    _worker['antithetic'] = antithetic
+    _worker['x'] = np.load(paths['x'], mmap_mode='r')
+    _worker['betas'] = np.load(paths['betas'], mmap_mode='r')
+    _worker['probs'] = np.load(paths['probs'], mmap_mode='r') if streams is None else None
+    _worker['history'] = np.load(paths['history'], mmap_mode='r+')
+    _worker['state'] = np.load(paths['state'], mmap_mode='r+') if 'state' in paths else None
+    _worker['social_care'] = np.load(paths['social_care'], mmap_mode='r+') if 'social_care' in paths else None
+
+
+def _simulate_chunk(start, stop):
+    """Simulates people start to stop writing straight into the shared history"""
+
+    plan = _worker['plan']
+    history = History(plan, _worker['mcsid'][start:stop], len(_worker['betas']), _worker['dtype'],
+                      values=_worker['history'][:, start:stop])
+    probs = _worker['streams'] if _worker['streams'] is not None else _worker['probs'][:, start:stop]
+    cohort = Cohort.from_arrays(plan, history.mcsid, _worker['x'][start:stop], _worker['betas'],
+                                probs, history, _worker['universes'], _worker['person_ids'][start:stop],
+                                dtype=_worker['dtype'], scenarios=_worker['scenarios'],
+                                antithetic=_worker['antithetic'])
+    with instrument.timer('pool.chunk'):
+        cohort.simulate_all_sweeps()
+    return instrument.collect()
+
+
+def _simulate_chunk_sweep(start, stop, sweep_num):
+    """Simulates one sweep for people start to stop continuing from the shared state"""
+
+    plan = _worker['plan']
+    history = History(plan, _worker['mcsid'][start:stop], len(_worker['betas']), _worker['dtype'],
+                      values=_worker['history'][:, start:stop])
+    probs = _worker['streams'] if _worker['streams'] is not None else _worker['probs'][:, start:stop]
+    cohort = Cohort.from_arrays(plan, history.mcsid, _worker['state'][:, start:stop], _worker['betas'],
+                                probs, history, _worker['universes'], _worker['person_ids'][start:stop],
+                                _worker['social_care'][:, start:stop], _worker['dtype'],
+                                _worker['scenarios'], _worker['antithetic'])
+    with instrument.timer('pool.chunk', sweep=sweep_num):
+        cohort.simulate_sweep(sweep_num)
+    return instrument.collect()
+
+
+class WorkerPool:
+    """
+    A class used to simulate a cohort in parallel across worker processes
+
+    The people, betas and random draws are written once to memory mapped
+    files that every worker opens when it starts, so nothing large is
+    pickled per task. Each task is just the start and stop of a contiguous
+    chunk of people, which the worker simulates for every universe with a
+    Cohort and writes straight into a shared memory mapped history. When
+    the draws come from RandomStreams only the small streams object is sent
+    to each worker, which draws what its chunk needs sweep by sweep, and
+    the results do not depend on the number of workers or the chunk size.
+
+    Context factors such as peer effects depend on the whole cohort so when
+    any are given the cohort is advanced in lockstep instead. The state of
+    every person is then also kept in shared memory mapped files, each
+    sweep is dispatched to the workers in chunks and once every chunk has
+    finished the factors for the next sweep are calculated over the whole
+    shared state before that sweep is dispatched.
+
+    ...
+
+    Attributes
+    ----------
+    num_workers : int
+        The number of worker processes
+    chunk_size : int
+        The number of people per task, None to split the cohort into four
+        chunks per worker
+    tmp_dir : str
+        Where the memory mapped files are created, e.g. /dev/shm to keep
+        them in memory, None for the system default
+    dtype : dtype
+        The float type the state and history are held in
+
+    Methods
+    -------
+    simulate(people, betas, probs, plan, universes=None, contexts=None, person_ids=None,
+             scenarios=None, antithetic=None)
+        Simulates every person in every universe and returns the History
+    """
+
+
+    def __init__(self, num_workers=None, chunk_size=None, tmp_dir=None, dtype=np.float64):
+        """
+        Parameters
+        ----------
+        num_workers : int, optional
+            The number of worker processes, defaults to the number of CPUs
+        chunk_size : int, optional
+            The number of people per task
+        tmp_dir : str, optional
+            Where the memory mapped files are created
+        dtype : dtype, optional
+            The float type to hold the state and history in, e.g.
+            np.float32 to halve their memory, default float64
+        """
+
+        self.num_workers = num_workers if num_workers is not None else os.cpu_count()
+        self.chunk_size = chunk_size
+        self.tmp_dir = tmp_dir
+        self.dtype = np.dtype(dtype)
+
+
+    def chunks(self, num_people):
+        """Returns the (start, stop) of each contiguous chunk of people"""
+
+        chunk_size = self.chunk_size
+        if chunk_size is None:
+            chunk_size = -(-num_people // (4 * self.num_workers))
+        chunk_size = max(1, chunk_size)
+        return [(start, min(start + chunk_size, num_people)) for start in range(0, num_people, chunk_size)]
+
+
+    def _write_inputs(self, work_dir, people, betas, probs, plan, history, contexts):
+        """Writes the memory mapped files the workers open and returns their paths"""
+
+        paths = {name: os.path.join(work_dir, name + '.npy') for name in ['x', 'betas', 'probs', 'history']}
+        x = people[plan.x_names].values.astype(self.dtype)
+        np.save(paths['x'], x)
+        np.save(paths['betas'], np.stack([b.values.astype(self.dtype) for b in betas]))
+        if not isinstance(probs, RandomStreams):
+            np.save(paths['probs'], np.stack([p[plan.probs_names].values.astype(float) for p in probs]))
+
+        if contexts:
+            # the state every sweep continues from, starting with the
+            # starting conditions saved to history
+            paths['state'] = os.path.join(work_dir, 'state.npy')
+            paths['social_care'] = os.path.join(work_dir, 'social_care.npy')
+            np.save(paths['state'], np.repeat(x[np.newaxis], len(betas), axis=0))
+            np.save(paths['social_care'], np.zeros(history.values.shape[:2], dtype=bool))
+            history.values[:, :, history.social_care_slots[0]] = 0
+            history.values[:, :, history.initial_slots] = x[:, plan.initial_positions]
+
+        np.save(paths['history'], history.values)
+        return paths
+
+
+    def simulate(self, people, betas, probs, plan, universes=None, contexts=None, person_ids=None,
+                 scenarios=None, antithetic=None):
+        """Simulates every person in every universe across the workers
+
+        Parameters
+        ----------
+        people : DataFrame
+            Contains all person specific characteristics for every individual,
+            one row per person
+        betas : list of DataFrame
+            The regression coefficients of each universe
+        probs : list of DataFrame or RandomStreams
+            The random draws of each universe, one row per person, or the
+            streams to draw them from
+        plan : SweepPlan
+            The compiled positional layout of the sweeps
+        universes : array_like, optional
+            The universe number of each element of betas, defaults to
+            0 to len(betas) - 1
+        contexts : dict, optional
+            Maps a sweep number to the ContextFactor list to recalculate
+            just before that sweep, the cohort is advanced in lockstep if given
+        person_ids : array_like, optional
+            The position of each person in the full population, used to
+            pick the random streams, defaults to 0 to num_people - 1
+        scenarios : list of Scenario, optional
+            The scenario to simulate each element of betas under
+        antithetic : array_like, optional
+            Whether to use antithetic draws for each element of betas
+
+        Returns
+        -------
+        History
+            The simulated history of every person in every universe
+        """
+
+        mcsid = people['mcsid_age0'].values
+        history = History(plan, mcsid, len(betas), self.dtype)
+        streams = probs if isinstance(probs, RandomStreams) else None
+        universes = np.arange(len(betas)) if universes is None else np.asarray(universes)
+        person_ids = np.arange(len(mcsid)) if person_ids is None else np.asarray(person_ids)
+
+        work_dir = tempfile.mkdtemp(prefix='lifesim2_', dir=self.tmp_dir)
+        try:
+            with instrument.timer('pool.setup'):
+                paths = self._write_inputs(work_dir, people, betas, probs, plan, history, contexts)
+
+            initargs = (plan, mcsid, paths, streams, universes, person_ids, self.dtype, scenarios, antithetic,
+                        instrument.enabled())
+            with ProcessPoolExecutor(self.num_workers, initializer=_attach, initargs=initargs) as executor:
+                starts, stops = zip(*self.chunks(len(mcsid)))
+                if not contexts:
+                    with instrument.timer('pool.dispatch'):
+                        for snapshot in executor.map(_simulate_chunk, starts, stops):
+                            instrument.merge(snapshot)
+                else:
+                    state = np.load(paths['state'], mmap_mode='r+')
+                    for sweep_num in range(2, 8):
+                        with instrument.timer('pool.context', sweep=sweep_num):
+                            for factor in contexts.get(sweep_num, []):
+                                factor.apply(state)
+                            state.flush()
+                        with instrument.timer('pool.dispatch', sweep=sweep_num):
+                            for snapshot in executor.map(_simulate_chunk_sweep, starts, stops, [sweep_num] * len(starts)):
+                                instrument.merge(snapshot)
+                    del state
+
+            with instrument.timer('pool.collect'):
+                history.values[:] = np.load(paths['history'], mmap_mode='r')
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        return history
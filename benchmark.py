@@ -0,0 +1,231 @@
+import pandas as pd
+import numpy as np
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from Cohort import Cohort
+from Person import Person
+from History import History
+from SweepPlan import SweepPlan
+from RandomStreams import RandomStreams
+from OutputSink import CsvSink, ParquetSink, SummarySink
+from WorkerPool import WorkerPool
+from inputs import read_betas
+from synthetic import synthetic_people
+import instrument
+
+# the number of sweeps each person is simulated through
+NUM_SWEEPS = 6
+
+
+def measure(stage, func, people, universes, workers, sweeps=NUM_SWEEPS):
+    """Runs one stage of the simulation and measures it
+
+    Peak memory is the most allocated by this process while the stage runs
+    as traced by tracemalloc, which numpy reports its arrays to. Worker
+    processes are not traced, simulate reports their memory instead.
+
+    Parameters
+    ----------
+    stage : str
+        The name of the stage
+    func : callable
+        Runs the stage, called with no arguments
+    people, universes, workers : int
+        The size of the run, people x universes x sweeps is the work done
+
+    Returns
+    -------
+    result
+        Whatever func returns
+    dict
+        The measurements of the stage
+    """
+
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    start_time = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start_time
+
+    row = {'stage': stage,
+           'people': people,
+           'universes': universes,
+           'workers': workers,
+           'seconds': seconds,
+           'people_sweeps_per_second': people * universes * sweeps / seconds if seconds > 0 else None,
+           'peak_memory_bytes': tracemalloc.get_traced_memory()[1] - baseline}
+    print(f"{stage:>16} people={people} universes={universes} workers={workers}: {seconds:.3f}s")
+    return result, row
+
+
+def simulate(mcs_people, sim_betas, streams, plan, num_workers):
+    """Simulates the cohort in process or across a WorkerPool
+
+    Returns the history and, across a WorkerPool, the largest resident size
+    in bytes any of the pool's workers reached, otherwise None.
+    """
+
+    if num_workers == 1:
+        cohort = Cohort(mcs_people, sim_betas, streams, plan)
+        cohort.simulate_all_sweeps()
+        return cohort.history, None
+
+    # the workers send back their resident memory with their timers while instrumentation is on
+    profiler = instrument.enable()
+    try:
+        history = WorkerPool(num_workers).simulate(mcs_people, sim_betas, streams, plan)
+    finally:
+        instrument.disable()
+    worker_rss = [stats[3] for (name, _), stats in profiler.timers.items()
+                  if name == 'pool.chunk' and stats[3] is not None]
+    return history, max(worker_rss, default=None)
+
+
+def simulate_people(mcs_people, betas, probs, plan):
+    """Simulates each person separately with Person"""
+
+    history = History(plan, mcs_people['mcsid_age0'].values)
+    for i in range(len(mcs_people)):
+        person = Person(mcs_people.iloc[i], betas, probs.iloc[i], plan, history, 0, i)
+        person.simulate_all_sweeps()
+    return history
+
+
+def write_outputs(sink, history):
+    """Writes every universe of a history to a sink"""
+
+    for universe in range(history.values.shape[0]):
+        sink.write(history, universe, universe)
+        sink.finish(universe)
+    sink.close()
+
+
+def benchmark(betas_file, people_counts, universe_counts, worker_counts, person_sample, seed=0):
+    """Times each stage of the simulation over a grid of run sizes
+
+    Parameters
+    ----------
+    betas_file : str
+        The Excel file with the Coefs and SE sheets of betas
+    people_counts, universe_counts, worker_counts : list of int
+        The grid of synthetic cohort sizes, universes and worker processes
+    person_sample : int
+        The most people to simulate one at a time with Person
+    seed : int
+        The seed of the synthetic cohorts and random draws
+
+    Returns
+    -------
+    list of dict
+        The measurements of each stage at each point of the grid
+    """
+
+    rows = []
+    try:
+        import pyarrow
+        has_pyarrow = True
+    except ImportError:
+        has_pyarrow = False
+
+    def preprocess():
+        betas = read_betas(betas_file, 'Coefs')
+        betas_se = read_betas(betas_file, 'SE')
+        return betas, betas_se, SweepPlan(betas, support=[betas, betas_se])
+    (betas, betas_se, plan), row = measure('preprocess', preprocess, 0, 0, 1, 0)
+    rows.append(row)
+
+    streams = RandomStreams(seed, plan)
+    tmp_dir = tempfile.mkdtemp(prefix='lifesim2_benchmark_')
+    try:
+        for num_people in people_counts:
+            mcs_people = synthetic_people(betas, num_people, seed)
+
+            # the original one person at a time engine on a sample of the cohort
+            sample = mcs_people.iloc[:min(person_sample, num_people)]
+            probs = streams.probs(0, np.arange(len(sample)))
+            _, row = measure('person', lambda: simulate_people(sample, betas, probs, plan), len(sample), 1, 1)
+            rows.append(row)
+
+            for num_universes in universe_counts:
+                sim_betas = [streams.sim_betas(n, betas, betas_se) for n in range(num_universes)]
+
+                for num_workers in worker_counts:
+                    (history, worker_rss), row = measure('simulate', lambda: simulate(mcs_people, sim_betas, streams,
+                                                                                      plan, num_workers),
+                                                         num_people, num_universes, num_workers)
+                    if num_workers > 1:
+                        row['worker_max_rss_bytes'] = worker_rss
+                    rows.append(row)
+
+                sizes = (num_people, num_universes, 1)
+                for stage, func in [
+                        ('history_wide', lambda: [history.wide(u) for u in range(num_universes)]),
+                        ('history_long', lambda: [history.long(u) for u in range(num_universes)]),
+                        ('output_csv', lambda: write_outputs(CsvSink(os.path.join(tmp_dir, 'history.csv')), history)),
+                        ('output_summary', lambda: write_outputs(SummarySink(os.path.join(tmp_dir, 'summary.csv')), history)),
+                        ]:
+                    rows.append(measure(stage, func, *sizes)[1])
+                if has_pyarrow:
+                    func = lambda: write_outputs(ParquetSink(os.path.join(tmp_dir, 'history')), history)
+                    rows.append(measure('output_parquet', func, *sizes)[1])
+
+                # start each output from scratch
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                os.makedirs(tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return rows
+
+
+def environment():
+    """Describes the code and machine the benchmark ran on"""
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit,
+            'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Times lifesim2 on synthetic MCS cohorts")
+    parser.add_argument('--people', type=int, nargs='+', default=[1000, 10000],
+                        help="the synthetic cohort sizes to run")
+    parser.add_argument('--universes', type=int, nargs='+', default=[1, 4],
+                        help="the numbers of parameter universes to run")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count()],
+                        help="the numbers of worker processes to run with")
+    parser.add_argument('--person-sample', type=int, default=200,
+                        help="the most people to simulate one at a time with Person")
+    parser.add_argument('--betas', default='data/betas.xlsx', help="the Excel file of betas")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json', help="where to write the JSON report")
+    args = parser.parse_args(argv)
+
+    tracemalloc.start()
+    rows = benchmark(args.betas, args.people, args.universes, args.workers, args.person_sample, args.seed)
+    tracemalloc.stop()
+
+    report = {'environment': environment(), 'results': rows}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(rows)} measurements to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
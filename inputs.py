@@ -0,0 +1,236 @@
+import pandas as pd
+import numpy as np
+import re
+import os
+import hashlib
+from functools import lru_cache
+import instrument
+
+# bump this whenever the preprocessing below changes so old caches are rebuilt
+CACHE_VERSION = 1
+
+# the rules used to standardise the variable names to be lower case and end
+# in _ageX, applied in order. Predictor rules apply to the columns of
+# mcs_people and the rows of betas, outcome rules to the columns of betas.
+# Each rule is (pattern, replacement, applies to predictors, applies to outcomes)
+RENAME_TABLE = [(re.compile(pattern), replacement, predictor, outcome) for pattern, replacement, predictor, outcome in [
+    (r'Age', r'_age', True, True),
+    (r'MP', r'_mp', True, False),
+    (r'INCEQ(\d+)log', r'log_eqv_inc_sweep\1', True, False),
+    (r'_sweep1', r'_age0', True, False),
+    (r'_sweep2', r'_age3', True, False),
+    (r'_sweep3', r'_age5', True, False),
+    (r'_sweep4', r'_age7', True, False),
+    (r'_sweep5', r'_age11', True, False),
+    (r'_sweep6', r'_age14', True, False),
+    (r'_sweep7', r'_age17', True, False),
+    (r'truancy(\d+)', r'truancy_age\1', True, True),
+    (r'exclP(\d+)', r'excl_age\1', True, True),
+    (r'Cigregular(\d+)', r'cigregular_age\1', True, True),
+    (r'antisoc_age(\d+)b', r'antisoc_age\1', True, True),
+    (r'senP(\d+)state', r'sen_age\1', True, True),
+    (r'Obese(\d+)_UK90', r'obeses_uk90_age\1', True, True),
+    (r'(\d+)\.country', r'country\1', True, False),
+    (r'(\d+)\.ETHCM6', r'ethnicity\1', True, False),
+    (r'Kessler(\d+)', r'kessler_age\1', False, True),
+    (r'MHconditions(\d+)', r'mh_conditions_age\1', False, True),
+    (r'badGCSE_ME', r'bad_gcse_age17', False, True),
+    (r'anxdepcurrent(\d+)', r'anxdepcurrent_age\1', False, True),
+    (r'Physicalcond(\d+)', r'physicalcond\1', False, True),
+    (r'Health(\d+)_poorfair', r'health_poorfair_age\1', False, True),
+    (r'^(?!.*_age\d+$)(.*)$', r'\1_age0', True, False),
+]]
+
+
+@lru_cache(maxsize=None)
+def rename(name, outcome=False):
+    """Standardises a variable name using the rename table
+
+    Parameters
+    ----------
+    name : str
+        The variable name as it appears in the input files
+    outcome : bool
+        Whether the name is an outcome (a column of betas) rather than a
+        predictor (a column of mcs_people or a row of betas)
+
+    Returns
+    -------
+    str
+        The lower case name ending in _ageX
+    """
+
+    for pattern, replacement, predictor, applies_to_outcome in RENAME_TABLE:
+        if (applies_to_outcome if outcome else predictor):
+            name = pattern.sub(replacement, name)
+    return name.lower()
+
+
+def file_hash(path):
+    """Returns the sha256 hex digest of a file's contents"""
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def inputs_hash(people_file, betas_file):
+    """Returns one sha256 hex digest covering the contents of both input files"""
+
+    return hashlib.sha256(f'{file_hash(people_file)}:{file_hash(betas_file)}'.encode()).hexdigest()
+
+
+def read_people(people_file):
+    """Reads all individuals in the first sweep of MCS
+
+    Parameters
+    ----------
+    people_file : str
+        The Excel file of MCS individuals
+
+    Returns
+    -------
+    DataFrame
+        One row per individual with standardised column names in sorted order
+    """
+
+    with instrument.timer('inputs.read_excel', sheet='people'):
+        mcs_people = pd.read_excel(people_file, header=0)
+
+    # drop any MCS members with missing variables
+    mcs_people = mcs_people.dropna()
+
+    # add constant column to pick up the regression constant
+    mcs_people['constant'] = 1
+
+    # drop columns for reference values in our equations as these are represented in the constant
+    mcs_people = mcs_people.drop(columns=['country', 'country1', 'ETHCM6', 'ethnicity1'])
+
+    with instrument.timer('inputs.rename'):
+        mcs_people.columns = [rename(col) for col in mcs_people.columns]
+    return mcs_people.sort_index(axis=1)
+
+
+def read_betas(betas_file, sheet_name):
+    """Reads a sheet of regression betas for the model equations
+
+    Parameters
+    ----------
+    betas_file : str
+        The Excel file of betas
+    sheet_name : str
+        The sheet to read, 'Coefs' for the betas or 'SE' for their standard errors
+
+    Returns
+    -------
+    DataFrame
+        Rows of independent variables and columns of outcomes with
+        standardised names in sorted order
+    """
+
+    with instrument.timer('inputs.read_excel', sheet=sheet_name):
+        betas = pd.read_excel(betas_file, sheet_name=sheet_name)
+    betas.set_index('variable', inplace=True)
+    betas.fillna(0.0, inplace=True)
+    betas.replace('.', 0.0, inplace=True)
+    betas = betas.apply(pd.to_numeric)
+
+    with instrument.timer('inputs.rename'):
+        betas.columns = [rename(col, outcome=True) for col in betas.columns]
+        betas.index = [rename(row) for row in betas.index]
+    return betas.sort_index(axis=1).sort_index(axis=0)
+
+
+def preprocess(people_file, betas_file):
+    """Reads and aligns the MCS individuals and regression betas
+
+    Parameters
+    ----------
+    people_file : str
+        The Excel file of MCS individuals
+    betas_file : str
+        The Excel file with the Coefs and SE sheets of betas
+
+    Returns
+    -------
+    mcs_people : DataFrame
+        One row per individual with a column for every row of betas
+    betas : DataFrame
+        The regression betas
+    betas_se : DataFrame
+        The standard errors of the regression betas
+    """
+
+    mcs_people = read_people(people_file)
+    betas = read_betas(betas_file, 'Coefs')
+    betas_se = read_betas(betas_file, 'SE')
+
+    # add columns to mcs_people to match any extra rows in beta
+    new_col_names = betas.index.difference(mcs_people.columns)
+    new_cols = pd.DataFrame(0, index=mcs_people.index, columns=new_col_names)
+    mcs_people = pd.concat([mcs_people, new_cols], axis=1)
+    mcs_people.sort_index(axis=1, inplace=True)
+
+    return mcs_people, betas, betas_se
+
+
+def load_inputs(people_file='data/mcs_people.xls', betas_file='data/betas.xlsx', cache_dir='cache'):
+    """Loads the preprocessed MCS individuals and regression betas
+
+    Reading the Excel files and standardising the names is slow so the
+    aligned matrices are cached as a numpy archive keyed by the content
+    hashes of the input files. Later runs and worker processes load the
+    cache directly and it is only rebuilt when an input file changes.
+
+    Parameters
+    ----------
+    people_file : str
+        The Excel file of MCS individuals
+    betas_file : str
+        The Excel file with the Coefs and SE sheets of betas
+    cache_dir : str
+        The directory to keep cached inputs in, set to None to disable caching
+
+    Returns
+    -------
+    mcs_people : DataFrame
+        One row per individual with a column for every row of betas
+    betas : DataFrame
+        The regression betas
+    betas_se : DataFrame
+        The standard errors of the regression betas
+    """
+
+    if cache_dir is None:
+        return preprocess(people_file, betas_file)
+
+    key = hashlib.sha256(f'{CACHE_VERSION}:{file_hash(people_file)}:{file_hash(betas_file)}'.encode()).hexdigest()
+    cache_file = os.path.join(cache_dir, f'inputs_{key[:16]}.npz')
+
+    if not os.path.exists(cache_file):
+        instrument.count('inputs.cache_miss')
+        mcs_people, betas, betas_se = preprocess(people_file, betas_file)
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # write to a temporary file first so a concurrent reader never sees half a cache
+        tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez(f,
+                     mcsid=mcs_people['mcsid_age0'].values.astype(str),
+                     people=mcs_people.drop(columns='mcsid_age0').values.astype(float),
+                     people_columns=mcs_people.columns.drop('mcsid_age0').values.astype(str),
+                     betas=betas.values, betas_se=betas_se.values,
+                     betas_index=betas.index.values.astype(str),
+                     betas_columns=betas.columns.values.astype(str))
+        os.replace(tmp_file, cache_file)
+
+    with instrument.timer('inputs.load_cache'), np.load(cache_file) as cache:
+        mcs_people = pd.DataFrame(cache['people'], columns=cache['people_columns'])
+        mcs_people['mcsid_age0'] = cache['mcsid']
+        mcs_people.sort_index(axis=1, inplace=True)
+        betas = pd.DataFrame(cache['betas'], index=cache['betas_index'], columns=cache['betas_columns'])
+        betas_se = pd.DataFrame(cache['betas_se'], index=cache['betas_index'], columns=cache['betas_columns'])
+
+    return mcs_people, betas, betas_se
@@ -0,0 +1,223 @@
+import contextlib
+import csv
+import json
+import sys
+import time
+
+# the profiler recording the current run, None while instrumentation is off
+_active = None
+
+# returned by timer while instrumentation is off so that timing a stage
+# costs no more than a function call
+_DISABLED = contextlib.nullcontext()
+
+
+def _max_rss():
+    """Returns the high-water mark of this process's resident memory in bytes
+
+    None where it cannot be measured, e.g. on Windows which has no resource
+    module, so profiling never stops the simulation from running.
+    """
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS and kilobytes elsewhere
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _larger(a, b):
+    """Returns the larger of two memory high-water marks either of which may be None"""
+
+    return b if a is None else a if b is None else max(a, b)
+
+
+class Profiler:
+    """
+    A class used to record named timers and counters over a run
+
+    Every timer is kept as running totals per name and labels, e.g. the
+    time spent in sweep 5 across all people, rather than as one record per
+    call so hot paths such as Person.simulate_sweep can be timed without the
+    trace growing with the size of the run.
+
+    ...
+
+    Attributes
+    ----------
+    timers : dict
+        Maps (name, labels) to [calls, total seconds, longest call in
+        seconds, memory high-water mark in bytes or None]
+    counters : dict
+        Maps each counter name to its total
+
+    Methods
+    -------
+    timer(name, **labels)
+        Times the block of code run inside it
+    count(name, n=1)
+        Adds n to a counter
+    merge(snapshot)
+        Adds the timers and counters recorded by another profiler
+    rows()
+        Returns one row per timer
+    write(path)
+        Writes the trace as JSON and CSV
+    """
+
+
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self.start_time = time.time()
+
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            key = (name, tuple(sorted(labels.items())))
+            stats = self.timers.get(key)
+            if stats is None:
+                stats = self.timers[key] = [0, 0.0, 0.0, None]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            stats[3] = _larger(stats[3], _max_rss())
+
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+
+    def snapshot(self):
+        """Returns the timers and counters recorded so far"""
+
+        return {'timers': {key: list(stats) for key, stats in self.timers.items()},
+                'counters': dict(self.counters)}
+
+
+    def merge(self, snapshot):
+        """Adds the timers and counters recorded by another profiler
+
+        Parameters
+        ----------
+        snapshot : dict
+            As returned by snapshot, e.g. from a worker process
+        """
+
+        for key, (calls, total, longest, rss) in snapshot['timers'].items():
+            stats = self.timers.setdefault(key, [0, 0.0, 0.0, None])
+            stats[0] += calls
+            stats[1] += total
+            stats[2] = max(stats[2], longest)
+            stats[3] = _larger(stats[3], rss)
+        for name, n in snapshot['counters'].items():
+            self.count(name, n)
+
+
+    def rows(self):
+        """Returns one row per timer sorted by name"""
+
+        rows = []
+        for (name, labels), (calls, total, longest, rss) in sorted(self.timers.items(), key=lambda item: str(item[0])):
+            rows.append({'name': name,
+                         'labels': ','.join(f'{k}={v}' for k, v in labels),
+                         'calls': calls,
+                         'total_seconds': total,
+                         'mean_seconds': total / calls,
+                         'max_seconds': longest,
+                         'max_rss_bytes': rss})
+        return rows
+
+
+    def write(self, path):
+        """Writes the trace to path.json and the timers to path.csv
+
+        Parameters
+        ----------
+        path : str
+            The file name without an extension
+        """
+
+        trace = {'start_time': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.start_time)),
+                 'wall_seconds': time.time() - self.start_time,
+                 'max_rss_bytes': _max_rss(),
+                 'timers': self.rows(),
+                 'counters': self.counters}
+        with open(path + '.json', 'w') as f:
+            json.dump(trace, f, indent=2)
+
+        fields = ['name', 'labels', 'calls', 'total_seconds', 'mean_seconds', 'max_seconds', 'max_rss_bytes']
+        with open(path + '.csv', 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(trace['timers'])
+
+
+def enable():
+    """Starts recording timers and counters, returning the Profiler"""
+
+    global _active
+    _active = Profiler()
+    return _active
+
+
+def disable():
+    """Stops recording, returning the Profiler that was recording if any"""
+
+    global _active
+    profiler, _active = _active, None
+    return profiler
+
+
+def enabled():
+    """Returns whether timers and counters are being recorded"""
+
+    return _active is not None
+
+
+def timer(name, **labels):
+    """Times the block of code run inside it when instrumentation is on
+
+    Parameters
+    ----------
+    name : str
+        The stage being timed, e.g. 'cohort.sweep'
+    **labels
+        Distinguish calls of the same stage, e.g. sweep=5
+    """
+
+    if _active is None:
+        return _DISABLED
+    return _active.timer(name, **labels)
+
+
+def count(name, n=1):
+    """Adds n to a counter when instrumentation is on"""
+
+    if _active is not None:
+        _active.count(name, n)
+
+
+def collect():
+    """Returns and clears what has been recorded, e.g. to send from a worker"""
+
+    if _active is None:
+        return None
+    snapshot = _active.snapshot()
+    _active.timers.clear()
+    _active.counters.clear()
+    return snapshot
+
+
+def merge(snapshot):
+    """Adds timers and counters recorded elsewhere when instrumentation is on"""
+
+    if _active is not None and snapshot is not None:
+        _active.merge(snapshot)
@@ -1,10 +1,21 @@
-import pandas as pd
 import numpy as np
-import re
+import argparse
+import os
 import time
 from tqdm import tqdm
-from joblib import Parallel, delayed
-from Person import Person
+from Cohort import Cohort, block_shape
+from SweepPlan import SweepPlan
+from History import History
+from RandomStreams import RandomStreams
+from ContextFactor import ContextFactor
+from Population import Population
+from Scenario import Scenario
+from OutputSink import CsvSink, ParquetSink, SummarySink, ScenarioSink
+from inputs import load_inputs, file_hash, inputs_hash
+from RunDirectory import RunDirectory
+from shards import parse_range, parse_shard, shard_range
+from WorkerPool import WorkerPool
+import instrument
 
 
 # specify the number of simulations universes we want to run to  
@@ -14,188 +25,318 @@ from Person import Person
 # if set to 1 will use deterministic betas directly from input
 num_universes = 30
 
-# import all individuals in the first sweep of MCS
-mcs_people = pd.read_excel('data/mcs_people.xls', header=0)
-
-# drop any MCS members with missing variables
-mcs_people = mcs_people.dropna()
-
-# calculate the total number of individuals we will simulate
-num_people = mcs_people.shape[0]
-
-# add constant column to pick up the regression constant
-mcs_people['constant'] = 1
-
-# drop columns for reference values in our equations as these are represented in the constant
-mcs_people = mcs_people.drop(columns=['country', 'country1', 'ETHCM6', 'ethnicity1'])
-
-# standardise the variable names to be lower case and end in _ageX
-mcs_people.columns = [col.replace('Age', '_age') for col in mcs_people.columns]
-mcs_people.columns = [col.replace('MP', '_mp') for col in mcs_people.columns]
-mcs_people.columns = [re.sub(r'INCEQ(\d+)log', r'log_eqv_inc_sweep\1', col) for col in mcs_people.columns]
-replace_dict = {'_sweep1': '_age0', '_sweep2': '_age3', '_sweep3': '_age5', '_sweep4': '_age7', '_sweep5': '_age11', '_sweep6': '_age14', '_sweep7': '_age17'}
-mcs_people.columns = mcs_people.columns.to_series().replace(replace_dict, regex=True)
-mcs_people.columns = [re.sub(r'truancy(\d+)', r'truancy_age\1', col) for col in mcs_people.columns]
-mcs_people.columns = [re.sub(r'exclP(\d+)', r'excl_age\1', col) for col in mcs_people.columns]
-mcs_people.columns = [re.sub(r'Cigregular(\d+)', r'cigregular_age\1', col) for col in mcs_people.columns]
-mcs_people.columns = [re.sub(r'antisoc_age(\d+)b', r'antisoc_age\1', col) for col in mcs_people.columns]
-mcs_people.columns = [re.sub(r'senP(\d+)state', r'sen_age\1', col) for col in mcs_people.columns]
-mcs_people.columns = [re.sub(r'Obese(\d+)_UK90', r'Obeses_UK90_age\1', col) for col in mcs_people.columns]
-mcs_people.columns = [re.sub(r'(\d+)\.country', r'country\1', col) for col in mcs_people.columns]
-mcs_people.columns = [re.sub(r'(\d+)\.ETHCM6', r'ethnicity\1', col) for col in mcs_people.columns]
-mcs_people.columns = [re.sub(r'^(?!.*_age\d+$)(.*)$', r'\1_age0', col) for col in mcs_people.columns]
-mcs_people.columns = mcs_people.columns.str.lower()
-mcs_people.sort_index(axis=1, inplace=True)
-
-# load the regression betas for the model equations
-betas = pd.read_excel('data/betas.xlsx', sheet_name='Coefs')
-betas.set_index('variable', inplace=True)
-betas.fillna(0.0, inplace=True)
-betas.replace('.', 0.0, inplace=True)
-betas = betas.apply(pd.to_numeric)
-
-# standardise the variable names to be lower case and end in _ageX
-betas.columns = [col.replace('Age', '_age') for col in betas.columns]
-betas.columns = [re.sub(r'Obese(\d+)_UK90', r'obeses_uk90_age\1', col) for col in betas.columns]
-betas.columns = [re.sub(r'senP(\d+)state', r'sen_age\1', col) for col in betas.columns]
-betas.columns = [re.sub(r'truancy(\d+)', r'truancy_age\1', col) for col in betas.columns]
-betas.columns = [re.sub(r'exclP(\d+)', r'excl_age\1', col) for col in betas.columns]
-betas.columns = [re.sub(r'Cigregular(\d+)', r'cigregular_age\1', col) for col in betas.columns]
-betas.columns = [re.sub(r'antisoc_age(\d+)b', r'antisoc_age\1', col) for col in betas.columns]
-betas.columns = [re.sub(r'Kessler(\d+)', r'kessler_age\1', col) for col in betas.columns]
-betas.columns = [re.sub(r'MHconditions(\d+)', r'mh_conditions_age\1', col) for col in betas.columns]
-betas.columns = [col.replace('badGCSE_ME', 'bad_gcse_age17') for col in betas.columns]
-betas.columns = [re.sub(r'anxdepcurrent(\d+)', r'anxdepcurrent_age\1', col) for col in betas.columns]
-betas.columns = [re.sub(r'Physicalcond(\d+)', r'physicalcond\1', col) for col in betas.columns]
-betas.columns = [re.sub(r'Health(\d+)_poorfair', r'health_poorfair_age\1', col) for col in betas.columns]
-betas.columns = betas.columns.str.lower()
-betas.sort_index(axis=1, inplace=True)
-
-betas.index = [row.replace('Age', '_age') for row in betas.index]
-betas.index = [row.replace('MP', '_mp') for row in betas.index]
-betas.index = [re.sub(r'INCEQ(\d+)log', r'log_eqv_inc_sweep\1', row) for row in betas.index]
-replace_dict = {'_sweep1': '_age0', '_sweep2': '_age3', '_sweep3': '_age5', '_sweep4': '_age7', '_sweep5': '_age11', '_sweep6': '_age14', '_sweep7': '_age17'}
-betas.index = betas.index.to_series().replace(replace_dict, regex=True)
-betas.index = [re.sub(r'truancy(\d+)', r'truancy_age\1', row) for row in betas.index]
-betas.index = [re.sub(r'exclP(\d+)', r'excl_age\1', row) for row in betas.index]
-betas.index = [re.sub(r'Cigregular(\d+)', r'cigregular_age\1', row) for row in betas.index]
-betas.index = [re.sub(r'antisoc_age(\d+)b', r'antisoc_age\1', row) for row in betas.index]
-betas.index = [re.sub(r'senP(\d+)state', r'sen_age\1', row) for row in betas.index]
-betas.index = [re.sub(r'Obese(\d+)_UK90', r'Obeses_UK90_age\1', row) for row in betas.index]
-betas.index = [re.sub(r'(\d+)\.country', r'country\1', row) for row in betas.index]
-betas.index = [re.sub(r'(\d+)\.ETHCM6', r'ethnicity\1', row) for row in betas.index]
-betas.index = [re.sub(r'^(?!.*_age\d+$)(.*)$', r'\1_age0', row) for row in betas.index]
-betas.index = betas.index.str.lower()
-betas.sort_index(axis=0, inplace=True)
-
-# add columns to mcs_people to match any extra rows in beta
-new_col_names = betas.index.difference(mcs_people.columns)
-new_cols = pd.DataFrame(0, index=mcs_people.index, columns=new_col_names)
-mcs_people = pd.concat([mcs_people, new_cols], axis=1)
-mcs_people.sort_index(axis=1, inplace=True)
-
-# load the regression betas standard errors for the model equations
-betas_se = pd.read_excel('data/betas.xlsx', sheet_name='SE')
-betas_se.set_index('variable', inplace=True)
-betas_se.fillna(0.0, inplace=True)
-betas_se.replace('.', 0.0, inplace=True)
-betas_se = betas_se.apply(pd.to_numeric) 
-
-# standardise the variable names to be lower case and end in _ageX
-betas_se.columns = [col.replace('Age', '_age') for col in betas_se.columns]
-betas_se.columns = [re.sub(r'Obese(\d+)_UK90', r'obeses_uk90_age\1', col) for col in betas_se.columns]
-betas_se.columns = [re.sub(r'senP(\d+)state', r'sen_age\1', col) for col in betas_se.columns]
-betas_se.columns = [re.sub(r'truancy(\d+)', r'truancy_age\1', col) for col in betas_se.columns]
-betas_se.columns = [re.sub(r'exclP(\d+)', r'excl_age\1', col) for col in betas_se.columns]
-betas_se.columns = [re.sub(r'Cigregular(\d+)', r'cigregular_age\1', col) for col in betas_se.columns]
-betas_se.columns = [re.sub(r'antisoc_age(\d+)b', r'antisoc_age\1', col) for col in betas_se.columns]
-betas_se.columns = [re.sub(r'Kessler(\d+)', r'kessler_age\1', col) for col in betas_se.columns]
-betas_se.columns = [re.sub(r'MHconditions(\d+)', r'mh_conditions_age\1', col) for col in betas_se.columns]
-betas_se.columns = [col.replace('badGCSE_ME', 'bad_gcse_age17') for col in betas_se.columns]
-betas_se.columns = [re.sub(r'anxdepcurrent(\d+)', r'anxdepcurrent_age\1', col) for col in betas_se.columns]
-betas_se.columns = [re.sub(r'Physicalcond(\d+)', r'physicalcond\1', col) for col in betas_se.columns]
-betas_se.columns = [re.sub(r'Health(\d+)_poorfair', r'health_poorfair_age\1', col) for col in betas_se.columns]
-betas_se.columns = betas_se.columns.str.lower()
-betas_se.sort_index(axis=1, inplace=True)
-
-betas_se.index = [row.replace('Age', '_age') for row in betas_se.index]
-betas_se.index = [row.replace('MP', '_mp') for row in betas_se.index]
-betas_se.index = [re.sub(r'INCEQ(\d+)log', r'log_eqv_inc_sweep\1', row) for row in betas_se.index]
-replace_dict = {'_sweep1': '_age0', '_sweep2': '_age3', '_sweep3': '_age5', '_sweep4': '_age7', '_sweep5': '_age11', '_sweep6': '_age14', '_sweep7': '_age17'}
-betas_se.index = betas_se.index.to_series().replace(replace_dict, regex=True)
-betas_se.index = [re.sub(r'truancy(\d+)', r'truancy_age\1', row) for row in betas_se.index]
-betas_se.index = [re.sub(r'exclP(\d+)', r'excl_age\1', row) for row in betas_se.index]
-betas_se.index = [re.sub(r'Cigregular(\d+)', r'cigregular_age\1', row) for row in betas_se.index]
-betas_se.index = [re.sub(r'antisoc_age(\d+)b', r'antisoc_age\1', row) for row in betas_se.index]
-betas_se.index = [re.sub(r'senP(\d+)state', r'sen_age\1', row) for row in betas_se.index]
-betas_se.index = [re.sub(r'Obese(\d+)_UK90', r'Obeses_UK90_age\1', row) for row in betas_se.index]
-betas_se.index = [re.sub(r'(\d+)\.country', r'country\1', row) for row in betas_se.index]
-betas_se.index = [re.sub(r'(\d+)\.ETHCM6', r'ethnicity\1', row) for row in betas_se.index]
-betas_se.index = [re.sub(r'^(?!.*_age\d+$)(.*)$', r'\1_age0', row) for row in betas_se.index]
-betas_se.index = betas_se.index.str.lower()
-betas_se.sort_index(axis=0, inplace=True)
-
-# set the seed to allow us to reproduce stochastic results
-np.random.seed(786110)
-
-# create the simulated betas combining the means and standard errors to create 
-# alternative parameter universes that we will use to capture the uncertainty
-# in the estimated equation coefficients
-sim_betas = []
-if num_universes > 1:
-  for i in range(num_universes):
-      sim_mean = betas + np.random.normal(scale=betas_se)
-      sim_betas.append(sim_mean)
-else:
-  sim_betas.append(betas)
-  
-# extract binary outcome variable names from the equations
-binary_cols = betas.columns[betas.columns.str.endswith(' b')].str.replace(' b$', '', regex=True)
-
-# add columns to represent entering into social care at various ages
-binary_cols = binary_cols.union(['social_care_age3','social_care_age5','social_care_age7','social_care_age11','social_care_age14','social_care_age17'])
-
-# add these binary columns as probability draws for each person in MCS
-# these probabilities will be used to simulate if binary outcomes occur
-sim_probs = []
-for i in range(num_universes):
-    df = pd.DataFrame(data=np.random.rand(num_people, binary_cols.size) ,columns=binary_cols)
-    sim_probs.append(df)
-
-# for a given person in MCS create an instance of the Person class and simulate
-# their life from ages 0 to 17 returning key events in their life history
-def simulate_person(mcs_individual, betas, probs):
-    person = Person(mcs_individual, betas, probs)
-    person.simulate_all_sweeps()
-    return person.history
-
-# the output file where we will save the simualtion history to
-output_file = "output/" + time.strftime("%Y%m%d-%H%M%S") + "_history_wide_universes_0_to_" + str(num_universes) + ".csv"
-
-# run the simulation for each parameter universe
-for n in tqdm(range(num_universes)):
-    start_time = time.time()
-    
-    # use joblib to run the function in parallel for each individual in the MCS
-    history_list = Parallel(n_jobs=-1)(delayed(simulate_person)(mcs_people.iloc[i], sim_betas[n], sim_probs[n].iloc[i]) for i in range(num_people))
-    
-    # collapse the list to a single dataframe
-    history = pd.concat(history_list, ignore_index=True)
-    
-    # convert to wide form
-    history = pd.pivot_table(history, values='value', index='mcsid', columns=['variable','age'])
-    history.columns = history.columns.map(lambda x: '{}_age{}'.format(x[0], x[1]))
-    history = history.reset_index()
-    history.insert(0, 'simulation', n)
-    
-    # append the overall history for all simulated MCS individuals for this parameter universe
-    # out to output_file adding a header row if file does not already exist 
-    with open(output_file, 'a') as f:
-      history.to_csv(f, mode='a', index=False, header=f.tell()==0)
-
-    elapsed_time = time.time() - start_time
-    
-    # print the elapsed time
-    print(f"The simulation {n} took {elapsed_time:.2f} seconds to run.")
-
-    
+# stop before num_universes once the cohort average of each of these outcomes
+# is estimated precisely enough, given as {column: tolerance} where the Monte
+# Carlo standard error of the average across universes (its standard
+# deviation over the square root of the number of universes) must be within
+# tolerance, e.g. {'zcog_age14': 0.01, 'obeses_uk90_age17': 0.005}. This is
+# checked every adaptive_check_every universes once at least
+# adaptive_min_universes are done, so where a run stops only depends on the
+# seed and inputs and not on the memory budget, workers or resuming. Empty to
+# always run num_universes
+adaptive_tolerances = {}
+adaptive_min_universes = 5
+adaptive_check_every = 5
+
+# universes are simulated together in blocks, as many as fit within this
+# memory budget (in bytes) are stacked and advanced through each sweep at once,
+# a population too large for even one universe to fit is simulated one
+# universe at a time in chunks of as many people as fit
+memory_budget = 2 * 1024**3
+
+# the number of children to simulate, drawn as a weighted bootstrap of the MCS
+# individuals to scale up to e.g. a national cohort, None to simulate the MCS
+# individuals themselves, and the column of MCS individuals holding their
+# weights, None to draw everyone with equal probability
+population_size = None
+population_weights = None
+
+# the float type to hold the simulation state and history in, np.float32
+# halves their memory so twice as many people fit in the memory budget
+state_dtype = np.float64
+
+# the number of worker processes to simulate with, None to use every CPU or
+# 1 to simulate in this process, and the number of people in each task
+num_workers = None
+chunk_size = None
+
+# the seed used to allow us to reproduce stochastic results
+seed = 786110
+
+# cohort specific context factors e.g. peer effects that are recalculated
+# between sweeps, given as {sweep_num: [(target, source, by), ...]} where the
+# mean of source within the groups of by is written to target before the
+# sweep, e.g. {5: [('peer_zcog_age7', 'zcog_age7', 'imd1_age0')]} needs a
+# peer_zcog_age7 row in betas. The cohort is then advanced in lockstep
+context_factors = {}
+
+# policy scenarios to simulate side by side in one pass, given as
+# {name: options} where options are those of Scenario and the first is the
+# baseline, e.g. {'baseline': {}, 'half_care': {'social_care_scale': 0.5},
+# 'no_zcog_effect': {'zcog_decrement': 0}}. Every scenario of a universe uses
+# the same random draws so the differences from the baseline, written to
+# scenarios.csv, need far fewer universes to settle than separate runs would.
+# The history and summary hold the baseline only. Empty for just the baseline
+scenarios = {}
+
+# also simulate every universe with antithetic draws, 1 - u in place of each
+# random draw u, and average each pair in scenarios.csv to cancel out much of
+# the noise of the draws
+antithetic = False
+
+# the format to save the simulation history in, either 'parquet' for a typed
+# dataset partitioned by simulation or 'csv' for a single appended file
+output_format = 'parquet'
+
+# record how long each stage of the run takes, including every sweep, and
+# the memory high-water marks to a trace saved next to the output
+profile = False
+
+# a summary of the distribution of each outcome across universes, overall
+# and by subgroup, is always written, set this to only write the summary
+# and not the full history of every person in every universe
+summary_only = False
+
+
+# the input files of MCS individuals and regression betas
+people_file = 'data/mcs_people.xls'
+betas_file = 'data/betas.xlsx'
+
+
+def simulate(people, sim_betas, streams, plan, universes, contexts, person_ids, pool, batch, flags):
+    """Simulates a chunk of people in every row of a block returning the History"""
+
+    if num_workers == 1:
+        cohort = Cohort(people, sim_betas, streams, plan, universes=universes, person_ids=person_ids,
+                        dtype=state_dtype, scenarios=batch, antithetic=flags)
+        for sweep_num, factors in contexts.items():
+            for factor in factors:
+                cohort.register_context(sweep_num, factor)
+        cohort.simulate_all_sweeps()
+        return cohort.history
+    return pool.simulate(people, sim_betas, streams, plan, universes, contexts, person_ids, batch, flags)
+
+
+def converged(summary, completed):
+    """Returns the standard error of each adaptive target if all are within tolerance"""
+
+    if summary is None or completed < max(adaptive_min_universes, 2):
+        return None
+    errors = dict(zip(adaptive_tolerances, summary.standard_errors(list(adaptive_tolerances)).tolist()))
+    if all(errors[column] <= tolerance for column, tolerance in adaptive_tolerances.items()):
+        return errors
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulates the MCS cohort from birth to age 17")
+    parser.add_argument('--run-dir', help="the directory to keep the outputs and manifest of the run in, "
+                                          "defaults to a new timestamped directory under output")
+    parser.add_argument('--resume', action='store_true',
+                        help="carry on from the completed universes of the run in --run-dir")
+    parser.add_argument('--universes', help="only simulate universes START:STOP, making the run a shard")
+    parser.add_argument('--people', help="only simulate people START:STOP of the population, making the run a shard")
+    parser.add_argument('--shard', help="only simulate the INDEX/COUNT-th of COUNT equal shares of the "
+                                        "universes or people, merge the shards with shards.py")
+    parser.add_argument('--shard-by', choices=['universes', 'people'], default='universes',
+                        help="whether --shard shares out the universes or the people")
+    args = parser.parse_args(argv)
+    if args.resume and args.run_dir is None:
+        parser.error("--resume needs the --run-dir of the run to carry on from")
+
+    if profile:
+        instrument.enable()
+
+    # load all individuals in the first sweep of MCS along with the regression
+    # betas for the model equations and their standard errors, these are read
+    # and aligned once and then cached until the input files change
+    with instrument.timer('inputs'):
+        mcs_people, betas, betas_se = load_inputs(people_file, betas_file)
+
+    # scale the MCS individuals up to the population we will simulate, its
+    # members are only built chunk by chunk as they are simulated
+    population = Population(mcs_people, population_size, population_weights, seed)
+
+    # calculate the total number of individuals we will simulate
+    num_people = population.size
+
+    # a shard of the run only simulates some of the universes and/or people,
+    # every random draw depends only on the universe and the person so shards
+    # can be run anywhere without coordination and merged afterwards
+    universe_range = parse_range(args.universes, num_universes)
+    people_range = parse_range(args.people, num_people)
+    if args.shard is not None:
+        if args.shard_by == 'universes':
+            universe_range = shard_range(*universe_range, *parse_shard(args.shard))
+        else:
+            people_range = shard_range(*people_range, *parse_shard(args.shard))
+    sharded = universe_range != (0, num_universes) or people_range != (0, num_people)
+    adaptive = bool(adaptive_tolerances) and num_universes > 1
+    if adaptive and sharded:
+        raise ValueError("Adaptive runs stop on the summary of every person in every universe so cannot be sharded")
+
+    # compile the positional layout of the sweep equations once, the simulated
+    # betas share the same labels so the one plan serves every universe, and
+    # prune each sweep to the predictors any simulated draw of betas can use
+    plan = SweepPlan(betas, support=[betas, betas_se])
+
+    # catch misspelt adaptive targets before any universe is simulated
+    if adaptive:
+        unknown = [column for column in adaptive_tolerances if column not in History(plan, np.array([]), 0).columns]
+        if unknown:
+            raise ValueError(f"Adaptive tolerances given for {unknown} which are not history columns")
+
+    # every random number is derived from the seed, the universe, the sweep
+    # and the person, so the simulated betas and the probability draws used
+    # to simulate if binary outcomes occur are only drawn when they are
+    # needed and are the same however the work is split up
+    streams = RandomStreams(seed, plan)
+
+    contexts = {sweep_num: [ContextFactor(plan, *factor) for factor in factors]
+                for sweep_num, factors in context_factors.items()}
+
+    # the scenarios simulated side by side, each with ordinary and if asked
+    # antithetic draws, the first being the baseline
+    batch = [Scenario(name, **options) for name, options in scenarios.items()] or [Scenario()]
+    flips = [False, True] if antithetic else [False]
+
+    # the run directory where we will save the simulation history and summary
+    # to along with a manifest of the settings needed to trace them back to the
+    # run that produced them and of the universes completed so far, a run is
+    # only resumed if the settings its results depend on are unchanged
+    run_dir = args.run_dir if args.run_dir is not None else "output/" + time.strftime("%Y%m%d-%H%M%S")
+    settings = {'seed': seed,
+                'inputs_sha256': inputs_hash(people_file, betas_file),
+                'betas_sha256': file_hash(betas_file),
+                'output_format': output_format,
+                'summary_only': summary_only,
+                'population_size': population_size,
+                'population_weights': population_weights,
+                'state_dtype': np.dtype(state_dtype).name,
+                'context_factors': {str(k): [list(f) for f in v] for k, v in context_factors.items()},
+                'scenarios': [scenario.settings() for scenario in batch],
+                'antithetic': antithetic}
+    if adaptive:
+        settings['adaptive'] = {'tolerances': adaptive_tolerances,
+                                'min_universes': adaptive_min_universes,
+                                'check_every': adaptive_check_every}
+    if sharded:
+        settings['shard'] = {'universes': list(universe_range), 'people': list(people_range),
+                             'num_universes': num_universes, 'num_people': num_people}
+    run = RunDirectory(run_dir, settings, resume=args.resume)
+    metadata = dict(settings, num_universes=num_universes)
+
+    # a shard only holds part of some universes so leaves summarising them
+    # until the shards are merged
+    sinks = {'summary': SummarySink(os.path.join(run_dir, "summary.csv"), metadata, defer=sharded)}
+    if not summary_only and output_format == 'csv':
+        sinks['history'] = CsvSink(os.path.join(run_dir, "history_wide.csv"), metadata)
+    elif not summary_only:
+        sinks['history'] = ParquetSink(os.path.join(run_dir, "history_wide"), metadata)
+    outputs = list(sinks.values())
+    if scenarios or antithetic:
+        sinks['scenarios'] = ScenarioSink(os.path.join(run_dir, "scenarios.csv"), [s.name for s in batch],
+                                          metadata, defer=sharded)
+
+    # carry on from the last completed universe, the random draws of every
+    # universe are fixed by the seed so the rest come out as they would have
+    run.restore(sinks)
+    pending = [n for n in run.pending(num_universes) if universe_range[0] <= n < universe_range[1]]
+
+    # run the simulation for each block of parameter universes and chunk of
+    # people splitting each chunk across the worker processes
+    pool = WorkerPool(num_workers, chunk_size, dtype=state_dtype)
+    people_start, people_stop = people_range
+    people_chunk, block_size = block_shape(people_stop - people_start, len(pending), betas,
+                                           memory_budget // (len(batch) * len(flips)), state_dtype)
+    if contexts and people_chunk < num_people:
+        raise ValueError(f"Context factors need all {num_people} people simulated together but only "
+                         f"{min(people_chunk, people_stop - people_start)} are, raise memory_budget "
+                         f"or shard by universes")
+
+    # an adaptive run checks whether to stop between rounds of
+    # adaptive_check_every universes so blocks never span two rounds
+    rounds = [pending]
+    if adaptive:
+        rounds = [[n for n in pending if start <= n < start + adaptive_check_every]
+                  for start in range(0, num_universes, adaptive_check_every)]
+    blocks = [universes[i:i + block_size] for universes in rounds for i in range(0, len(universes), block_size)]
+
+    for universes in tqdm(blocks):
+        # the summary holds exactly the universes before a round when it
+        # starts, the universes of every round being simulated in order
+        if adaptive and universes[0] % adaptive_check_every == 0:
+            errors = converged(sinks['summary'].summary, universes[0])
+            if errors is not None:
+                run.record('stopped', {'universes': universes[0], 'standard_errors': errors})
+                print(f"Stopping after {universes[0]} universes, the standard errors {errors} are within tolerance")
+                break
+
+        start_time = time.time()
+
+        # create the simulated betas combining the means and standard errors to create
+        # alternative parameter universes that we will use to capture the uncertainty
+        # in the estimated equation coefficients
+        with instrument.timer('sim_betas'):
+            if num_universes > 1:
+                sim_betas = [streams.sim_betas(n, betas, betas_se) for n in universes]
+            else:
+                sim_betas = [betas]
+
+        # every scenario of every universe in the block, with ordinary and
+        # antithetic draws, is simulated as one row sharing the universe's
+        # random draws
+        rows = [(scenario, i, flip) for scenario in batch for i in range(len(universes)) for flip in flips]
+
+        for start in range(people_start, people_stop, people_chunk):
+            stop = min(start + people_chunk, people_stop)
+            with instrument.timer('population'):
+                people = population.chunk(start, stop)
+
+            # simulate the chunk from ages 0 to 17 in lockstep for every
+            # row of the block returning the key events in each individual's
+            # life history, the random draws of each person depend on their
+            # position in the population not in the chunk
+            with instrument.timer('simulate'):
+                history = simulate(people, [sim_betas[i] for _, i, _ in rows], streams, plan,
+                                   [universes[i] for _, i, _ in rows], contexts, np.arange(start, stop), pool,
+                                   [scenario for scenario, _, _ in rows], [flip for _, _, flip in rows])
+
+            # write out the history of the chunk for each parameter universe
+            # under the baseline and every row to the scenario summary
+            for row, (scenario, i, flip) in enumerate(rows):
+                if scenario is batch[0] and not flip:
+                    for sink in outputs:
+                        with instrument.timer('output', sink=type(sink).__name__):
+                            sink.write(history, row, universes[i], start)
+                if 'scenarios' in sinks:
+                    with instrument.timer('output', sink='ScenarioSink'):
+                        sinks['scenarios'].write(history, row, universes[i], start, scenario.name)
+
+            # only one chunk is held at a time
+            del people, history
+
+        # commit the whole block at once when every chunk of it has been
+        # written, the sinks already hold every universe of the block so a
+        # checkpoint part way through would count the rest as committed
+        for n in universes:
+            for sink in sinks.values():
+                sink.finish(n)
+        with instrument.timer('commit'):
+            run.commit(list(universes), sinks)
+
+        elapsed_time = time.time() - start_time
+
+        # print the elapsed time
+        print(f"The simulations {universes[0]} to {universes[-1]} took {elapsed_time:.2f} seconds to run.")
+
+    for sink in sinks.values():
+        with instrument.timer('output.close', sink=type(sink).__name__):
+            sink.close()
+
+    if profile:
+        instrument.disable().write(os.path.join(run_dir, "profile"))
+
+
+if __name__ == '__main__':
+    main()
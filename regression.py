@@ -0,0 +1,215 @@
+import numpy as np
+import argparse
+import contextlib
+import filecmp
+import os
+import shutil
+import sys
+import tempfile
+from Cohort import Cohort, block_shape
+from SweepPlan import SweepPlan
+from RandomStreams import RandomStreams
+from WorkerPool import WorkerPool
+from RunDirectory import RunDirectory
+from inputs import read_betas
+from synthetic import synthetic_people
+from benchmark import simulate_people
+
+
+def check(betas_file, num_people, num_universes, seed=0):
+    """Checks every way of simulating a synthetic cohort gives the same history
+
+    The cohort is simulated with one Cohort and compared, value for value,
+    with simulating each person separately with Person, with a WorkerPool
+    of two workers and with a Cohort run chunk by chunk of people. All of
+    them draw from the same RandomStreams so must match exactly.
+
+    Parameters
+    ----------
+    betas_file : str
+        The Excel file with the Coefs and SE sheets of betas
+    num_people, num_universes : int
+        The size of the synthetic cohort and the number of universes
+    seed : int
+        The seed of the synthetic cohort and random draws
+
+    Returns
+    -------
+    dict
+        Maps each way of simulating to the largest absolute difference of
+        its history from the Cohort's, inf where missing values differ
+    """
+
+    betas = read_betas(betas_file, 'Coefs')
+    betas_se = read_betas(betas_file, 'SE')
+    plan = SweepPlan(betas, support=[betas, betas_se])
+    streams = RandomStreams(seed, plan)
+    people = synthetic_people(betas, num_people, seed)
+    universes = list(range(num_universes))
+    sim_betas = [streams.sim_betas(n, betas, betas_se) for n in universes]
+
+    cohort = Cohort(people, sim_betas, streams, plan, universes=universes)
+    cohort.simulate_all_sweeps()
+    expected = cohort.history.values
+
+    results = {}
+    person_ids = np.arange(num_people)
+    results['person'] = np.stack([simulate_people(people, sim_betas[n], streams.probs(n, person_ids), plan).values[0]
+                                  for n in universes])
+
+    pool = WorkerPool(2, chunk_size=max(1, num_people // 5))
+    results['pool'] = pool.simulate(people, sim_betas, streams, plan, universes).values
+
+    # chunks of uneven size, one of a single person, so no chunk boundary lines up with a pool chunk
+    bounds = [0, num_people // 3, num_people // 3 + 1, num_people // 3 + 8, num_people]
+    chunks = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        chunk = Cohort(people.iloc[start:stop], sim_betas, streams, plan, universes=universes,
+                       person_ids=person_ids[start:stop])
+        chunk.simulate_all_sweeps()
+        chunks.append(chunk.history.values)
+    results['chunked'] = np.concatenate(chunks, axis=1)
+
+    differences = {}
+    for name, values in results.items():
+        if not np.array_equal(np.isnan(values), np.isnan(expected)):
+            differences[name] = np.inf
+        else:
+            differences[name] = float(np.nanmax(np.abs(values - expected), initial=0.0))
+    return differences
+
+
+class _Crash(Exception):
+    """Stands in for the run being killed"""
+
+
+@contextlib.contextmanager
+def _configured(module, **config):
+    """Sets module level configuration for the duration of the block"""
+
+    saved = {name: getattr(module, name) for name in config}
+    for name, value in config.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(module, name, value)
+
+
+def check_resume(betas_file, num_people, num_universes, seed=0, output_format='csv'):
+    """Checks a run killed part way and resumed writes what an uninterrupted run does
+
+    lifesim2 is run on a synthetic cohort with a memory budget that stacks
+    several universes in each block, once straight through and once dying
+    just before its second commit and then resumed. The history and the
+    summary of the two runs must be identical.
+
+    Parameters
+    ----------
+    betas_file : str
+        The Excel file with the Coefs and SE sheets of betas
+    num_people, num_universes : int
+        The size of the synthetic cohort and the number of universes, at
+        least 4 so the run commits more than one block
+    seed : int
+        The seed of the synthetic cohort and random draws
+    output_format : str
+        The format to save the history in, 'csv' or 'parquet'
+
+    Returns
+    -------
+    list of str
+        The outputs that differ between the two runs, empty if none do
+    """
+
+    import lifesim2
+    from OutputSink import read_parquet_output
+
+    betas = read_betas(betas_file, 'Coefs')
+    betas_se = read_betas(betas_file, 'SE')
+    people = synthetic_people(betas, num_people, seed)
+
+    # the smallest doubling of the budget that stacks at least two, and so at most three, universes
+    memory_budget = 1 << 16
+    while block_shape(num_people, num_universes, betas, memory_budget)[1] < 2:
+        memory_budget *= 2
+
+    commits = []
+
+    class CrashingRunDirectory(RunDirectory):
+        def commit(self, simulation, sinks):
+            commits.append(simulation)
+            if len(commits) == 2:
+                raise _Crash(f"killed before committing {simulation}")
+            super().commit(simulation, sinks)
+
+    tmp_dir = tempfile.mkdtemp(prefix='lifesim2_regression_')
+    straight, resumed = os.path.join(tmp_dir, 'straight'), os.path.join(tmp_dir, 'resumed')
+    try:
+        # the synthetic people stand in for the people file, which is not
+        # distributed, so the betas file is hashed in its place
+        with _configured(lifesim2, load_inputs=lambda *files: (people.copy(), betas.copy(), betas_se.copy()),
+                         people_file=betas_file, betas_file=betas_file, num_universes=num_universes,
+                         memory_budget=memory_budget, num_workers=1, seed=seed, output_format=output_format):
+            lifesim2.main(['--run-dir', straight])
+            with _configured(lifesim2, RunDirectory=CrashingRunDirectory):
+                try:
+                    lifesim2.main(['--run-dir', resumed])
+                except _Crash:
+                    pass
+            if len(commits) < 2:
+                raise ValueError(f"The run finished in {len(commits)} commit so was never killed, "
+                                 f"use more universes")
+            lifesim2.main(['--run-dir', resumed, '--resume'])
+
+        differences = []
+        if not filecmp.cmp(os.path.join(straight, 'summary.csv'), os.path.join(resumed, 'summary.csv'),
+                           shallow=False):
+            differences.append('summary')
+        if output_format == 'csv':
+            same = filecmp.cmp(os.path.join(straight, 'history_wide.csv'),
+                               os.path.join(resumed, 'history_wide.csv'), shallow=False)
+        else:
+            same = read_parquet_output(os.path.join(straight, 'history_wide')).equals(
+                read_parquet_output(os.path.join(resumed, 'history_wide')))
+        if not same:
+            differences.append('history')
+        return differences
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Checks lifesim2's simulation paths agree on a synthetic cohort")
+    parser.add_argument('--people', type=int, default=200, help="the synthetic cohort size")
+    parser.add_argument('--universes', type=int, default=4, help="the number of parameter universes, "
+                                                                 "at least 4 to check resuming")
+    parser.add_argument('--betas', default='data/betas.xlsx', help="the Excel file of betas")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    differences = check(args.betas, args.people, args.universes, args.seed)
+    for name, difference in differences.items():
+        print(f"{name:>8} max difference from Cohort: {difference:g}")
+
+    mismatched = [name for name, difference in differences.items() if difference != 0]
+    if mismatched:
+        sys.exit(f"Simulation paths disagree with Cohort: {mismatched}")
+    print("Every simulation path matches Cohort exactly")
+
+    formats = ['csv']
+    try:
+        import pyarrow
+        formats.append('parquet')
+    except ImportError:
+        pass
+    for output_format in formats:
+        differences = check_resume(args.betas, args.people, args.universes, args.seed, output_format)
+        if differences:
+            sys.exit(f"A resumed {output_format} run differs from an uninterrupted one in {differences}")
+        print(f"A killed and resumed {output_format} run matches an uninterrupted one")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+import argparse
+import contextlib
+import json
+import os
+import pickle
+import shutil
+from OutputSink import CsvSink, ParquetSink, SummarySink, ScenarioSink
+from RunDirectory import RunDirectory
+
+
+def parse_range(spec, total):
+    """Parses a START:STOP range of universes or people
+
+    Parameters
+    ----------
+    spec : str or None
+        The range as START:STOP, either end can be left out, None for
+        everything
+    total : int
+        The number of universes or people in the whole run
+
+    Returns
+    -------
+    tuple of int
+        The start and stop of the range
+    """
+
+    if spec is None:
+        return 0, total
+    start, _, stop = spec.partition(':')
+    start = int(start) if start else 0
+    stop = int(stop) if stop else total
+    if not 0 <= start < stop <= total:
+        raise ValueError(f"Invalid range {spec}, must lie within 0:{total} and not be empty")
+    return start, stop
+
+
+def shard_range(start, stop, index, count):
+    """Returns the index-th of count near equal contiguous shares of start to stop
+
+    Parameters
+    ----------
+    start, stop : int
+        The range being shared out
+    index : int
+        Which share, from 0 to count - 1
+    count : int
+        The number of shares
+
+    Returns
+    -------
+    tuple of int
+        The start and stop of the share
+    """
+
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard {index}/{count}, the index must be between 0 and {count - 1}")
+    size = stop - start
+    return start + size * index // count, start + size * (index + 1) // count
+
+
+def parse_shard(spec):
+    """Parses an INDEX/COUNT shard spec returning (index, count)"""
+
+    index, _, count = spec.partition('/')
+    return int(index), int(count)
+
+
+def _coverage(manifests):
+    """Checks the shards cover every person of every universe exactly once"""
+
+    shard = manifests[0]['settings']['shard']
+    num_universes, num_people = shard['num_universes'], shard['num_people']
+
+    covered = {n: [] for n in range(num_universes)}
+    for manifest in manifests:
+        for n in manifest['completed']:
+            covered[n].append(tuple(manifest['settings']['shard']['people']))
+
+    for n, ranges in covered.items():
+        position = 0
+        for start, stop in sorted(ranges):
+            if start != position:
+                raise ValueError(f"Universe {n} is missing people {position}:{start} or has them more than once")
+            position = stop
+        if position != num_people:
+            raise ValueError(f"Universe {n} is missing people {position}:{num_people}")
+    return num_universes
+
+
+def _merge_csv(path, files, manifests, num_universes):
+    """Writes the rows of each universe in turn, taking them from its shards in person order
+
+    Each shard's file holds its universes in order with their people in
+    population order, so the files are read side by side in one pass.
+    """
+
+    with contextlib.ExitStack() as stack:
+        readers = [stack.enter_context(open(file)) for file in files]
+        merged = stack.enter_context(open(path, 'w'))
+
+        # only the first shard's header is kept
+        merged.write(readers[0].readline())
+        for reader in readers[1:]:
+            reader.readline()
+
+        lines = [reader.readline() for reader in readers]
+        for n in range(num_universes):
+            shards = sorted((manifest['settings']['shard']['people'], i) for i, manifest in enumerate(manifests)
+                            if n in manifest['completed'])
+            prefix = f'{n},'
+            for _, i in shards:
+                while lines[i].startswith(prefix):
+                    merged.write(lines[i])
+                    lines[i] = readers[i].readline()
+
+        leftover = [file for file, line in zip(files, lines) if line]
+        if leftover:
+            raise ValueError(f"{leftover} hold rows of universes their manifests do not list as completed")
+
+
+def merge_shards(run_dir, shard_dirs):
+    """Combines the run directories of the shards of a run into one
+
+    Every shard must have been run with the same settings, apart from
+    which universes and people it simulated, and together the completed
+    universes of the shards must cover every person of every universe
+    exactly once. The history of each shard is copied into a new run
+    directory and the deferred summary sums of the shards are added
+    together before each universe is summarised in order, so the result
+    is what running every shard's work in one run would have written. The
+    merged history lists each universe in turn with its people in the
+    order of the population, whichever way the run was sharded.
+
+    Parameters
+    ----------
+    run_dir : str
+        The new run directory to write the merged run to
+    shard_dirs : list of str
+        The run directories of the shards
+    """
+
+    manifests = []
+    for shard_dir in shard_dirs:
+        with open(os.path.join(shard_dir, 'manifest.json')) as f:
+            manifests.append(json.load(f))
+
+    settings = {key: value for key, value in manifests[0]['settings'].items() if key != 'shard'}
+    for shard_dir, manifest in zip(shard_dirs, manifests):
+        if 'shard' not in manifest['settings']:
+            raise ValueError(f"{shard_dir} is not a shard of a run")
+        other = {key: value for key, value in manifest['settings'].items() if key != 'shard'}
+        if other != settings:
+            raise ValueError(f"{shard_dir} was run with different settings to {shard_dirs[0]}")
+    num_universes = _coverage(manifests)
+
+    # the shards with any completed universes in the order a single run would have simulated them
+    order = sorted([i for i, manifest in enumerate(manifests) if manifest['completed']],
+                   key=lambda i: (manifests[i]['settings']['shard']['universes'],
+                                  manifests[i]['settings']['shard']['people']))
+
+    run = RunDirectory(run_dir, settings)
+    metadata = dict(settings, num_universes=num_universes)
+    sinks = {'summary': SummarySink(os.path.join(run_dir, "summary.csv"), metadata)}
+    if 'scenarios' in manifests[order[0]]['sinks']:
+        names = [scenario['name'] for scenario in settings['scenarios']]
+        sinks['scenarios'] = ScenarioSink(os.path.join(run_dir, "scenarios.csv"), names, metadata)
+
+    # add up the sums of every shard and then summarise each universe in turn
+    for name in list(sinks):
+        summary = None
+        for i in order:
+            state_file = os.path.join(shard_dirs[i], f"{name}_state_{manifests[i]['sinks'][name]['checkpoint']}.pkl")
+            with open(state_file, 'rb') as f:
+                shard_summary = pickle.load(f)
+            if summary is None:
+                summary = shard_summary
+            else:
+                summary.merge(shard_summary)
+        for n in summary.unfinished():
+            summary.finish(n)
+        sinks[name].summary = summary
+
+    if not settings['summary_only'] and settings['output_format'] == 'csv':
+        sinks['history'] = CsvSink(os.path.join(run_dir, "history_wide.csv"), metadata)
+        _merge_csv(sinks['history'].path, [os.path.join(shard_dirs[i], "history_wide.csv") for i in order],
+                   [manifests[i] for i in order], num_universes)
+    elif not settings['summary_only']:
+        sinks['history'] = ParquetSink(os.path.join(run_dir, "history_wide"), metadata)
+        for i in order:
+            for n in manifests[i]['completed']:
+                partition = f'simulation={n}'
+                source = os.path.join(shard_dirs[i], "history_wide", partition)
+                os.makedirs(os.path.join(sinks['history'].path, partition), exist_ok=True)
+                # parts are named by the zero padded position of their first person so they
+                # never clash and keep their names to still read back in person order
+                for name in sorted(os.listdir(source)):
+                    if name.endswith('.parquet'):
+                        shutil.copyfile(os.path.join(source, name),
+                                        os.path.join(sinks['history'].path, partition, name))
+        for n in range(num_universes):
+            sinks['history'].finish(n)
+
+    run.commit(list(range(num_universes)), sinks)
+    for sink in sinks.values():
+        sink.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merges the run directories of the shards of a lifesim2 run")
+    parser.add_argument('run_dir', help="the new run directory to write the merged run to")
+    parser.add_argument('shard_dirs', nargs='+', help="the run directories of the shards")
+    args = parser.parse_args(argv)
+
+    merge_shards(args.run_dir, args.shard_dirs)
+    print(f"Merged {len(args.shard_dirs)} shards into {args.run_dir}")
+
+
+if __name__ == '__main__':
+    main()
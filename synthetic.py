@@ -0,0 +1,83 @@
+import pandas as pd
+import numpy as np
+import re
+from SweepPlan import SweepPlan
+
+# the continuous starting characteristics as (mean, standard deviation),
+# every other starting characteristic is a 0/1 indicator
+CONTINUOUS = {
+    'agemb': (28.7, 5.8),
+    'malm': (29.1, 5.6),
+    'bmadv': (0.0, 1.0),
+    'zittotal': (0.0, 1.0),
+    'log_eqv_inc': (9.5, 0.6),
+    'cmagem': (40.0, 3.0),
+}
+
+# sets of dummy variables of which at most one is set, the reference
+# category being none of them
+DUMMIES = [r'country\d+_age0', r'ethnicity\d+_age0']
+
+
+def synthetic_people(betas, num_people, seed=0, prevalence=0.3):
+    """Generates a synthetic MCS cohort matching the columns betas expects
+
+    The real MCS individuals are not distributed with the model, this
+    creates any number of made up individuals laid out as load_inputs
+    returns them so the simulation can be run and timed without them. Only
+    the layout and plausible ranges of the values are realistic.
+
+    Parameters
+    ----------
+    betas : DataFrame
+        The regression betas, their rows fix the columns of the cohort
+    num_people : int
+        The number of individuals to generate
+    seed : int, optional
+        The seed to generate them from
+    prevalence : float, optional
+        The share of people with each 0/1 indicator set
+
+    Returns
+    -------
+    DataFrame
+        One row per individual with an mcsid_age0 column and a column for
+        every row of betas in sorted order
+    """
+
+    rng = np.random.default_rng(seed)
+    plan = SweepPlan(betas)
+
+    # outcomes of the sweeps are overwritten by the simulation so start at 0
+    simulated = set()
+    for sweep in plan.sweeps.values():
+        if sweep.in_x:
+            simulated |= set(plan.x_names[sweep.continuous_targets]) | set(plan.x_names[sweep.binary_targets])
+
+    people = {}
+    for name in plan.x_names:
+        variable = re.sub(r'_age\d+$', '', name)
+        if name in simulated:
+            people[name] = np.zeros(num_people)
+        elif name == 'constant_age0':
+            people[name] = np.ones(num_people)
+        elif name == 'imd1_age0':
+            people[name] = rng.integers(1, 11, num_people).astype(float)
+        elif variable in CONTINUOUS:
+            mean, sd = CONTINUOUS[variable]
+            people[name] = rng.normal(mean, sd, num_people)
+        elif name.endswith('_age0') or name == 'lifelimiting_age3':
+            people[name] = (rng.random(num_people) < prevalence).astype(float)
+        else:
+            people[name] = np.zeros(num_people)
+
+    # each set of dummies codes one category drawn with equal probability
+    for pattern in DUMMIES:
+        names = [name for name in plan.x_names if re.fullmatch(pattern, name)]
+        category = rng.integers(0, len(names) + 1, num_people)
+        for i, name in enumerate(names):
+            people[name] = (category == i + 1).astype(float)
+
+    people = pd.DataFrame(people)
+    people['mcsid_age0'] = [f'S{i:07d}' for i in range(num_people)]
+    return people.sort_index(axis=1)